@@ -18,6 +18,15 @@ Usage:
   python agent.py --mode rank          # Recalculate all rankings
   python agent.py --mode alert         # Check for breaking safety events
   python agent.py --mode single --city "Tokyo, Japan"  # Process single city
+  python agent.py --mode add --workers 8   # Generate up to 8 cities concurrently
+  python agent.py --mode batch-submit      # Submit add + refresh work as one Message Batch
+  python agent.py --mode batch-collect     # Save results of finished Message Batches
+  python agent.py --mode sanitize          # Re-sanitize every stored city (no API calls)
+  python agent.py --mode images            # Backfill missing Wikipedia images
+  python agent.py --mode add --shard 0/4   # Worker 0 of 4: cities whose id hashes to shard 0
+  python agent.py --mode merge-shards      # Combine shards/*/ into data, changelog and site data
+  python agent.py --mode export-changelog  # Write logs/changelog.json from the JSONL log
+  python agent.py --mode full --fake-api   # Offline run against fake_anthropic.py (use a scratch copy)
 
 Scheduling (cron examples):
   # Full pipeline — weekly on Sunday at 2 AM
@@ -34,12 +43,31 @@ import json
 import os
 import sys
 import argparse
+import atexit
+import bisect
+import functools
+import hashlib
+import heapq
+import http.client
 import logging
+import math
+import random
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import Optional
+from urllib.parse import quote, urlencode, urlsplit
+from xml.sax.saxutils import escape
 
 import anthropic
+import numpy as np
 
 # ---------------------------------------------------------------------------
 # Configuration
@@ -50,35 +78,120 @@ CONFIG = {
     "max_tokens": 16384,
     "data_dir": Path("./data/cities"),
     "queue_file": Path("./data/city_queue.json"),
+    "work_queue_db": Path("./data/.work-queue.sqlite3"),  # Per-item state behind the queue file (untracked)
+    "queue_lease_minutes": 30,          # Leased items not finished by then are retried
+    "queue_max_attempts": 3,            # Failed generations before an item is parked as failed
+    "batch_lease_hours": 25,            # Lease on queue items in a Message Batch (results expire at 24h)
     "rankings_file": Path("./data/rankings.json"),
+    "score_schema": "site",             # Key of SCORE_SCHEMAS used for rankings
+    "ranking_history_dir": Path("./data/ranking_history"),  # One row per city per rank run
+    "trend_window_days": 90,            # Window for the improving/declining trend
+    "site_aggregates_file": Path("./src/lib/site-data/aggregates.json"),  # Post-rank groupings
+    "related_cities_count": 5,
+    "staleness_index_file": Path("./data/.staleness-index.json"),
+    "batches_file": Path("./data/message_batches.json"),  # Submitted, not yet collected
+    "alert_state_file": Path("./data/alert_state.json"),  # city_id -> last alert check
     "log_file": Path("./logs/agent.log"),
-    "changelog_file": Path("./logs/changelog.json"),
+    "site_data_file": Path("./src/lib/city-data.json"),  # Built from the shards by build-city-data.js
+    "site_shards_dir": Path("./src/lib/site-data"),  # Per-city shards + index: the published site data
+    "site_url": "https://www.isitsafetovisit.com",
+    "sitemap_file": Path("./public/sitemap.xml"),
+    "changelog_file": Path("./logs/changelog.json"),    # JSON array export, on demand (not committed)
+    "changelog_jsonl": Path("./logs/changelog.jsonl"),  # Append-only source of truth
+    "changelog_segment_bytes": 5_000_000,  # Rotate the hot JSONL segment past this size
+    "changelog_fsync_every": 25,           # Entries between fsyncs
     "staleness_threshold_days": 30,
     "batch_size_add": 8,       # New cities to add per run
     "batch_size_refresh": 10,  # Stale cities to refresh per run
+    "message_batch_size_add": 100,      # Queue entries per Message Batch submission
+    "message_batch_size_refresh": 100,  # Stale cities per Message Batch submission
     "confidence_threshold": 0.6,
+    "alert_shard_size": 40,    # Cities per alert prompt
+    "alert_sla_hours": 24,     # Every city is alert-checked at least this often
+    "alert_run_interval_hours": 6,      # How often --mode alert is scheduled
+    "shard": None,                      # (index, count) when run with --shard i/N
+    "shard_dir": Path("./shards"),      # Per-shard outputs, combined by --mode merge-shards
+    "max_workers": 4,          # Concurrent Claude calls per add/refresh batch
+    "cache_dir": Path("./data/.cache/responses"),
+    "cache_mode": "readwrite",  # readwrite | off | replay (cache only, never call the API)
+    "cache_ttl_hours": 24,
+    "cache_max_bytes": 200_000_000,
+    "image_cache_file": Path("./data/.cache/images.json"),
+    "image_negative_ttl_days": 7,       # Re-query titles with no image after this long
+    "wikipedia_api": "https://en.wikipedia.org/w/api.php",
+    "fetch_images": True,               # Look up missing imageUrl while sanitizing
+    "rate_limit_rpm": 50,               # Requests per minute
+    "rate_limit_input_tpm": 30_000,     # Input tokens per minute
+    "rate_limit_output_tpm": 8_000,     # Output tokens per minute
+    "api_max_retries": 5,               # Retries on 429/529/5xx/connection errors
+    "api_backoff_base": 2.0,            # Seconds; doubled per retry, with jitter
+    "api_backoff_max": 60.0,
+    "stream": True,                     # Stream responses (early truncation detection)
+    "client_backend": "anthropic",      # "anthropic" or "fake" (fake_anthropic.py, no network)
+    "fake_api": {                       # FakeAnthropic knobs; see fake_anthropic.FakeBackend
+        "latency": 0.5, "jitter": 0.5, "tokens_per_second": 400,
+        "rate_429": 0.05, "rate_529": 0.02, "truncate_rate": 0.05, "malformed_rate": 0.03,
+        "alert_rate": 0.0, "seed": None,
+    },
+    "max_continuations": 2,             # Follow-up calls to finish a max_tokens cut-off
+    "run_report_file": Path("./logs/run_report.json"),   # Metrics of the last run
+    "metrics_textfile": Path("./logs/agent.prom"),       # Same, for node_exporter's textfile collector
+    "pricing": {                        # USD, for cost estimates in the run report
+        "input_per_mtok": 3.0,
+        "output_per_mtok": 15.0,
+        "web_search_per_1k": 10.0,
+        "batch_discount": 0.5,
+    },
 }
 
-# Category weights for overall score calculation
-CATEGORY_WEIGHTS = {
-    "crime": 0.25,
-    "health": 0.15,
-    "political_stability": 0.15,
-    "infrastructure": 0.10,
-    "natural_disaster": 0.10,
-    "scams_and_fraud": 0.10,
-    "lgbtq_safety": 0.05,
-    "women_safety": 0.05,
-    "night_safety": 0.05,
+# Scoring schemas: category weights, tier floors (highest first) and the score
+# change that counts as a trend. "legacy" is the original 0-100 nine-category
+# schema; "site" is the 1-10 seven-category schema the generator writes and
+# src/lib/cities.ts reads. Weights are renormalised over the categories a
+# record actually has.
+SCORE_SCHEMAS = {
+    "legacy": {
+        "weights": {
+            "crime": 0.25,
+            "health": 0.15,
+            "political_stability": 0.15,
+            "infrastructure": 0.10,
+            "natural_disaster": 0.10,
+            "scams_and_fraud": 0.10,
+            "lgbtq_safety": 0.05,
+            "women_safety": 0.05,
+            "night_safety": 0.05,
+        },
+        "tiers": [
+            (85, "very_safe", "Very Safe"),
+            (70, "generally_safe", "Generally Safe"),
+            (55, "moderate", "Moderate Risk"),
+            (40, "elevated", "Elevated Risk"),
+            (0, "high_risk", "High Risk"),
+        ],
+        "trend_delta": 3,
+    },
+    "site": {
+        # overallScore is the plain average of the seven categories
+        "weights": {
+            "pettyCrime": 1,
+            "violentCrime": 1,
+            "scamRisk": 1,
+            "womensSafety": 1,
+            "nightSafety": 1,
+            "transport": 1,
+            "naturalHazards": 1,
+        },
+        "tiers": [
+            (7.0, "safe", "Generally Safe"),
+            (5.0, "caution", "Moderate Caution"),
+            (0, "danger", "Exercise Caution"),
+        ],
+        "trend_delta": 0.3,
+    },
 }
-
-SAFETY_TIERS = [
-    (85, 100, "very_safe", "Very Safe"),
-    (70, 84, "generally_safe", "Generally Safe"),
-    (55, 69, "moderate", "Moderate Risk"),
-    (40, 54, "elevated", "Elevated Risk"),
-    (0, 39, "high_risk", "High Risk"),
-]
+# The seven site-facing category scores (1-10) used for similarity and distributions
+SCORE_FIELDS = tuple(SCORE_SCHEMAS["site"]["weights"])
 
 # ---------------------------------------------------------------------------
 # Logging Setup
@@ -95,32 +208,571 @@ def setup_logging():
         ],
     )
 
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+
+
+class Histogram:
+    """Fixed-bucket histogram (upper bounds HISTOGRAM_BUCKETS, then +Inf) with count, sum and max."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimate like Prometheus histogram_quantile: linear within the bucket, capped at max."""
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            if n and seen + n >= rank:
+                lower = HISTOGRAM_BUCKETS[i - 1] if i else 0.0
+                upper = HISTOGRAM_BUCKETS[i] if i < len(HISTOGRAM_BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+
+class Metrics:
+    """Process-wide counters and histograms, keyed by metric name and labels.
+
+    Histograms are bucketed as they are observed, so memory stays bounded
+    however long the run; the run report's percentiles are estimated from
+    the buckets.
+    """
+
+    def __init__(self):
+        self.started = datetime.now(timezone.utc)
+        self.counters: dict[tuple, float] = defaultdict(float)
+        self.histograms: dict[tuple, Histogram] = defaultdict(Histogram)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self.counters[self._key(name, labels)] += value
+
+    def observe(self, name: str, value: float, **labels):
+        with self._lock:
+            self.histograms[self._key(name, labels)].observe(value)
+
+    def counter(self, name: str, **labels) -> float:
+        return self.counters.get(self._key(name, labels), 0)
+
+    @staticmethod
+    def histogram_stats(histogram: Histogram) -> dict:
+        return {"count": histogram.count, "sum": round(histogram.sum, 4),
+                "p50": round(histogram.quantile(0.5), 4),
+                "p95": round(histogram.quantile(0.95), 4),
+                "max": round(histogram.max, 4)}
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": round(value, 6)}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{"name": name, "labels": dict(labels), **self.histogram_stats(histogram)}
+                          for (name, labels), histogram in sorted(self.histograms.items())
+                          if histogram.count]
+        return {"counters": counters, "histograms": histograms}
+
+    def prometheus(self) -> str:
+        """Prometheus text exposition format (counters and cumulative histograms)."""
+        def fmt(labels: tuple, extra: tuple = ()) -> str:
+            pairs = [f'{k}="{v}"' for k, v in labels + extra]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{fmt(labels)} {value:g}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (n, labels), histogram in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    count = 0
+                    for bound, n_bucket in zip(HISTOGRAM_BUCKETS, histogram.buckets):
+                        count += n_bucket
+                        lines.append(f"{name}_bucket{fmt(labels, (('le', f'{bound:g}'),))} {count}")
+                    lines.append(f"{name}_bucket{fmt(labels, (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_sum{fmt(labels)} {histogram.sum:g}")
+                    lines.append(f"{name}_count{fmt(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+_metrics: Optional[Metrics] = None
+
+
+def get_metrics() -> Metrics:
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def instrumented(name: str, io: bool = False):
+    """Time every call of the decorated function as a pipeline stage or file I/O op.
+
+    Records agent_stage_seconds{stage=name} (or agent_io_seconds{op=name})
+    and counts exceptions in agent_stage_errors_total / agent_io_errors_total.
+    """
+    metric, label = ("agent_io", "op") if io else ("agent_stage", "stage")
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                get_metrics().inc(f"{metric}_errors_total", **{label: name})
+                raise
+            finally:
+                get_metrics().observe(f"{metric}_seconds", time.monotonic() - started, **{label: name})
+        return wrapper
+    return decorate
+
+
+def record_claude_usage(kind: str, usage, batch: bool = False):
+    """Token, web search and estimated cost counters for one Claude response."""
+    if usage is None:
+        return
+    metrics = get_metrics()
+    pricing = CONFIG["pricing"]
+    input_tokens = getattr(usage, "input_tokens", 0) or 0
+    output_tokens = getattr(usage, "output_tokens", 0) or 0
+    searches = getattr(getattr(usage, "server_tool_use", None), "web_search_requests", 0) or 0
+    metrics.inc("claude_input_tokens_total", input_tokens, kind=kind)
+    metrics.inc("claude_output_tokens_total", output_tokens, kind=kind)
+    metrics.inc("claude_web_searches_total", searches, kind=kind)
+    cost = (input_tokens * pricing["input_per_mtok"] + output_tokens * pricing["output_per_mtok"]) / 1e6
+    if batch:
+        cost *= pricing["batch_discount"]
+    cost += searches * pricing["web_search_per_1k"] / 1000
+    metrics.inc("claude_cost_usd_total", cost, kind=kind)
+
+
+def run_report_summary(snapshot: dict) -> list[str]:
+    """Fixed-width tables of stage, I/O and Claude metrics for the log."""
+    counters = defaultdict(float)
+    for c in snapshot["counters"]:
+        counters[(c["name"], tuple(sorted(c["labels"].items())))] = c["value"]
+    lines = [f"{'stage / op':<28}{'calls':>7}{'total s':>10}{'p50 s':>9}{'p95 s':>9}{'errors':>8}"]
+    for h in snapshot["histograms"]:
+        if h["name"] not in ("agent_stage_seconds", "agent_io_seconds"):
+            continue
+        label = "stage" if h["name"] == "agent_stage_seconds" else "op"
+        errors = counters[(h["name"].replace("_seconds", "_errors_total"), ((label, h["labels"][label]),))]
+        lines.append(f"{h['labels'][label]:<28}{h['count']:>7}{h['sum']:>10.1f}{h['p50']:>9.2f}"
+                     f"{h['p95']:>9.2f}{errors:>8g}")
+
+    lines.append(f"{'claude kind':<28}{'calls':>7}{'p50 s':>9}{'p95 s':>9}{'in tok':>10}"
+                 f"{'out tok':>10}{'search':>8}{'errors':>8}{'cost $':>9}")
+    kinds = sorted({c["labels"]["kind"] for c in snapshot["counters"] if "kind" in c["labels"]}
+                   | {h["labels"]["kind"] for h in snapshot["histograms"] if h["name"] == "claude_call_seconds"})
+    for kind in kinds:
+        calls = next((h for h in snapshot["histograms"]
+                      if h["name"] == "claude_call_seconds" and h["labels"].get("kind") == kind), None)
+        errors = sum(c["value"] for c in snapshot["counters"]
+                     if c["name"] == "claude_errors_total" and c["labels"].get("kind") == kind)
+        k = (("kind", kind),)
+        lines.append(f"{kind:<28}{calls['count'] if calls else 0:>7}"
+                     f"{calls['p50'] if calls else 0:>9.2f}{calls['p95'] if calls else 0:>9.2f}"
+                     f"{counters[('claude_input_tokens_total', k)]:>10g}"
+                     f"{counters[('claude_output_tokens_total', k)]:>10g}"
+                     f"{counters[('claude_web_searches_total', k)]:>8g}{errors:>8g}"
+                     f"{counters[('claude_cost_usd_total', k)]:>9.3f}")
+    return lines
+
+
+def write_run_report(mode: str):
+    """Write the JSON run report and Prometheus textfile, and log the summary tables."""
+    metrics = get_metrics()
+    finished = datetime.now(timezone.utc)
+    snapshot = metrics.snapshot()
+    report = {
+        "mode": mode,
+        "started": metrics.started.isoformat(),
+        "finished": finished.isoformat(),
+        "duration_seconds": round((finished - metrics.started).total_seconds(), 3),
+        "estimated_cost_usd": round(sum(c["value"] for c in snapshot["counters"]
+                                        if c["name"] == "claude_cost_usd_total"), 4),
+        **snapshot,
+        "rate_limiter": dict(_rate_limiter.metrics) if _rate_limiter is not None else {},
+    }
+    for path, text in ((CONFIG["run_report_file"], json.dumps(report, indent=2, default=str)),
+                       (CONFIG["metrics_textfile"], metrics.prometheus())):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(text)
+        tmp.replace(path)
+
+    logging.info(f"Run report ({report['duration_seconds']:.1f}s, est. ${report['estimated_cost_usd']:.3f}) "
+                 f"written to {CONFIG['run_report_file']}")
+    for line in run_report_summary(snapshot):
+        logging.info(line)
+
+
 # ---------------------------------------------------------------------------
 # Anthropic Client
 # ---------------------------------------------------------------------------
 
 def get_client():
-    """Initialize Anthropic client. Expects ANTHROPIC_API_KEY env var."""
-    return anthropic.Anthropic()
+    """Initialize Anthropic client. Expects ANTHROPIC_API_KEY env var.
 
+    SDK retries are off: send_message and api_call retry with the shared RateLimiter.
+    With CONFIG["client_backend"] = "fake", returns the offline FakeAnthropic,
+    which answers from data/cities with injected latency and faults.
+    """
+    if CONFIG["client_backend"] == "fake":
+        from fake_anthropic import FakeAnthropic
+        return FakeAnthropic(CONFIG["data_dir"], **CONFIG["fake_api"])
+    return anthropic.Anthropic(max_retries=0)
 
-def call_claude(client, system_prompt: str, user_prompt: str, use_search: bool = True) -> str:
-    """Call Claude with optional web search tool."""
-    tools = []
-    if use_search:
-        tools.append({"type": "web_search_20250305", "name": "web_search"})
 
-    messages = [{"role": "user", "content": user_prompt}]
+# ---------------------------------------------------------------------------
+# Rate Limiting
+# ---------------------------------------------------------------------------
 
-    response = client.messages.create(
-        model=CONFIG["model"],
-        max_tokens=CONFIG["max_tokens"],
-        system=system_prompt,
-        messages=messages,
-        tools=tools if tools else anthropic.NOT_GIVEN,
-    )
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class TokenBucket:
+    """Continuously refilling budget of `per_minute` units."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` (capped at capacity) is available."""
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate) if self.rate else 0.0
+
+    def take(self, amount: float):
+        self.level -= amount
+
+    def sync(self, remaining: float):
+        """Trust the server when it reports less headroom than we think we have."""
+        self.level = min(self.level, remaining)
+
+
+class RateLimiter:
+    """Requests/min and input/output tokens/min budgets shared by every worker thread.
+
+    Budgets are debited before each call (input tokens are estimated from
+    prompt length, then corrected from the usage block), tightened from the
+    anthropic-ratelimit-* response headers, and retryable failures back off
+    with full jitter.
+    """
+
+    def __init__(self, rpm: float, input_tpm: float, output_tpm: float):
+        self.requests = TokenBucket(rpm)
+        self.input_tokens = TokenBucket(input_tpm)
+        self.output_tokens = TokenBucket(output_tpm)
+        self._lock = threading.Lock()
+        self.metrics = defaultdict(float)
+
+    def acquire(self, estimated_input_tokens: int):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                for bucket in (self.requests, self.input_tokens, self.output_tokens):
+                    bucket.refill(now)
+                wait = max(self.requests.wait_time(1),
+                           self.input_tokens.wait_time(estimated_input_tokens),
+                           self.output_tokens.wait_time(1))
+                if wait <= 0:
+                    self.requests.take(1)
+                    self.input_tokens.take(estimated_input_tokens)
+                    self.metrics["requests"] += 1
+                    return
+                self.metrics["throttled_seconds"] += wait
+            time.sleep(wait)
+
+    def record_usage(self, usage, estimated_input_tokens: int):
+        if usage is None:
+            return
+        input_tokens = getattr(usage, "input_tokens", 0) or 0
+        output_tokens = getattr(usage, "output_tokens", 0) or 0
+        with self._lock:
+            self.input_tokens.take(input_tokens - estimated_input_tokens)
+            self.output_tokens.take(output_tokens)
+            self.metrics["input_tokens"] += input_tokens
+            self.metrics["output_tokens"] += output_tokens
+
+    def record_latency(self, seconds: float, first_token: Optional[float]):
+        with self._lock:
+            self.metrics["calls"] += 1
+            self.metrics["call_seconds"] += seconds
+            if first_token is not None:
+                self.metrics["first_token_seconds"] += first_token
+
+    def observe_headers(self, headers):
+        if not headers:
+            return
+        with self._lock:
+            for name, bucket in (("requests", self.requests),
+                                 ("input-tokens", self.input_tokens),
+                                 ("output-tokens", self.output_tokens)):
+                remaining = headers.get(f"anthropic-ratelimit-{name}-remaining")
+                if remaining is not None:
+                    try:
+                        bucket.sync(float(remaining))
+                    except ValueError:
+                        pass
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self.metrics[name] += value
+
+    def backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Sleep before retry `attempt` (1-based) and return the delay."""
+        try:
+            delay = float(retry_after) if retry_after else None
+        except ValueError:
+            delay = None
+        if delay is None:
+            cap = min(CONFIG["api_backoff_max"], CONFIG["api_backoff_base"] * 2 ** (attempt - 1))
+            delay = random.uniform(0, cap)
+        with self._lock:
+            self.metrics["retries"] += 1
+            self.metrics["backoff_seconds"] += delay
+        time.sleep(delay)
+        return delay
+
+
+_rate_limiter: Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(CONFIG["rate_limit_rpm"],
+                                    CONFIG["rate_limit_input_tpm"],
+                                    CONFIG["rate_limit_output_tpm"])
+    return _rate_limiter
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS
+
+
+def stream_message(messages, params: dict):
+    """Stream one message; return (final message, response headers, seconds to first token).
+
+    A max_tokens stop is logged as soon as its message_delta event arrives.
+    """
+    started = time.monotonic()
+    first_token = None
+    with messages.stream(**params) as stream:
+        headers = getattr(getattr(stream, "response", None), "headers", None)
+        for event in stream:
+            if first_token is None and event.type == "content_block_delta":
+                first_token = time.monotonic() - started
+            elif event.type == "message_delta" and event.delta.stop_reason == "max_tokens":
+                logging.warning(f"Claude output hit max_tokens ({params['max_tokens']}) after "
+                                f"{time.monotonic() - started:.1f}s")
+        return stream.get_final_message(), headers, first_token
+
+
+def send_message(client, params: dict):
+    """One Claude message under the shared rate limiter, retrying retryable errors.
+
+    Streams when CONFIG["stream"] is set and the client supports it, and
+    logs latency and token usage for every call.
+    """
+    limiter = get_rate_limiter()
+    metrics = get_metrics()
+    kind = call_kind(params.get("system", ""))
+    estimated = (len(params.get("system", "")) + sum(len(m["content"]) for m in params["messages"])) // 4
+    messages = client.messages
+    for attempt in range(CONFIG["api_max_retries"] + 1):
+        limiter.acquire(estimated)
+        started = time.monotonic()
+        first_token = None
+        try:
+            if CONFIG["stream"] and hasattr(messages, "stream"):
+                response, headers, first_token = stream_message(messages, params)
+                limiter.observe_headers(headers)
+            elif hasattr(messages, "with_raw_response"):
+                raw = messages.with_raw_response.create(**params)
+                limiter.observe_headers(raw.headers)
+                response = raw.parse()
+            else:
+                response = messages.create(**params)
+        except Exception as e:
+            status = getattr(e, 'status_code', type(e).__name__)
+            limiter.count(f"errors_{status}")
+            metrics.inc("claude_errors_total", kind=kind, status=status)
+            if not is_retryable(e) or attempt == CONFIG["api_max_retries"]:
+                raise
+            headers = getattr(getattr(e, "response", None), "headers", None) or {}
+            limiter.observe_headers(headers)
+            delay = limiter.backoff(attempt + 1, headers.get("retry-after"))
+            logging.warning(f"Claude call failed ({e}); retry {attempt + 1}/{CONFIG['api_max_retries']} in {delay:.1f}s")
+            continue
+
+        elapsed = time.monotonic() - started
+        usage = getattr(response, "usage", None)
+        limiter.record_usage(usage, estimated)
+        limiter.record_latency(elapsed, first_token)
+        metrics.observe("claude_call_seconds", elapsed, kind=kind)
+        if first_token is not None:
+            metrics.observe("claude_first_token_seconds", first_token, kind=kind)
+        record_claude_usage(kind, usage)
+        ttft = f", first token {first_token:.1f}s" if first_token is not None else ""
+        logging.info(f"Claude call: {elapsed:.1f}s{ttft}, "
+                     f"{getattr(usage, 'input_tokens', '?')} in / {getattr(usage, 'output_tokens', '?')} out tokens, "
+                     f"stop={getattr(response, 'stop_reason', '?')}")
+        return response
+
+
+def call_kind(system_prompt: str) -> str:
+    """Metrics label for a Claude call, from the system prompt it was made with."""
+    return {SYSTEM_PROMPT_GENERATE: "generate", SYSTEM_PROMPT_REFRESH: "refresh",
+            SYSTEM_PROMPT_ALERT: "alert"}.get(system_prompt, "other")
+
+
+def api_call(func, *args, **kwargs):
+    """Call a non-message endpoint (Message Batches) with send_message's retry policy.
+
+    These calls don't draw on the messages rate limits, so only the backoff
+    and error counters of the shared RateLimiter are used.
+    """
+    limiter = get_rate_limiter()
+    for attempt in range(CONFIG["api_max_retries"] + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            limiter.count(f"errors_{getattr(e, 'status_code', type(e).__name__)}")
+            if not is_retryable(e) or attempt == CONFIG["api_max_retries"]:
+                raise
+            headers = getattr(getattr(e, "response", None), "headers", None) or {}
+            delay = limiter.backoff(attempt + 1, headers.get("retry-after"))
+            logging.warning(f"{getattr(func, '__name__', 'API')} call failed ({e}); "
+                            f"retry {attempt + 1}/{CONFIG['api_max_retries']} in {delay:.1f}s")
+
+
+def log_rate_limit_metrics():
+    if _rate_limiter is None:
+        return
+    summary = ", ".join(f"{k}={round(v, 1):g}" for k, v in sorted(_rate_limiter.metrics.items()))
+    logging.info(f"Claude API metrics: {summary}")
+
+
+class CacheMiss(Exception):
+    """Raised in replay mode when a prompt has no cached response."""
+
+
+def response_cache_key(system_prompt: str, user_prompt: str, tools: list) -> str:
+    """Content address of a Claude request: model + prompts + tools."""
+    material = json.dumps({
+        "model": CONFIG["model"],
+        "max_tokens": CONFIG["max_tokens"],
+        "system": system_prompt,
+        "user": user_prompt,
+        "tools": tools,
+    }, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def get_cached_response(key: str) -> Optional[str]:
+    """Cached response text, or None if missing or (outside replay mode) expired."""
+    if CONFIG["cache_mode"] == "off":
+        return None
+    path = CONFIG["cache_dir"] / f"{key}.json"
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    age_hours = (datetime.now(timezone.utc).timestamp() - entry["created"]) / 3600
+    if CONFIG["cache_mode"] != "replay" and age_hours > CONFIG["cache_ttl_hours"]:
+        return None
+    return entry["text"]
+
+
+def put_cached_response(key: str, text: str):
+    if CONFIG["cache_mode"] != "readwrite" or not text.strip():
+        return
+    cache_dir = CONFIG["cache_dir"]
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = cache_dir / f"{key}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"created": datetime.now(timezone.utc).timestamp(),
+                   "model": CONFIG["model"], "text": text}, f, ensure_ascii=False)
+    tmp.replace(cache_dir / f"{key}.json")
+    prune_response_cache()
+
+
+def evict_cached_response(system_prompt: str, user_prompt: str, use_search: bool = True):
+    """Drop a cached response that turned out to be unusable (not in replay mode)."""
+    if CONFIG["cache_mode"] == "readwrite":
+        key = response_cache_key(system_prompt, user_prompt, claude_tools(use_search))
+        (CONFIG["cache_dir"] / f"{key}.json").unlink(missing_ok=True)
+
+
+def prune_response_cache():
+    """Evict oldest entries until the cache fits in CONFIG["cache_max_bytes"]."""
+    entries = []
+    for path in CONFIG["cache_dir"].glob("*.json"):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CONFIG["cache_max_bytes"]:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+
+def claude_tools(use_search: bool) -> list[dict]:
+    return [{"type": "web_search_20250305", "name": "web_search"}] if use_search else []
+
+
+def claude_request_params(system_prompt: str, user_prompt: str, tools: list) -> dict:
+    """messages.create keyword arguments, shared by direct and batched calls."""
+    params = {
+        "model": CONFIG["model"],
+        "max_tokens": CONFIG["max_tokens"],
+        "system": system_prompt,
+        "messages": [{"role": "user", "content": user_prompt}],
+    }
+    if tools:
+        params["tools"] = tools
+    return params
 
-    # Extract text from response blocks, skipping search result blocks
+
+def response_text(response) -> str:
+    """Join the text blocks of a Claude message, skipping search result blocks."""
     text_parts = []
     for block in response.content:
         if hasattr(block, "text") and block.type == "text":
@@ -137,55 +789,354 @@ def call_claude(client, system_prompt: str, user_prompt: str, use_search: bool =
     return result
 
 
+def call_claude(client, system_prompt: str, user_prompt: str, use_search: bool = True,
+                cache: bool = True) -> str:
+    """Call Claude with optional web search tool, via the on-disk response cache.
+
+    Pass cache=False for time-sensitive prompts (alerts) that must always
+    hit the API, except in replay mode.
+    """
+    tools = claude_tools(use_search)
+
+    key = response_cache_key(system_prompt, user_prompt, tools)
+    cached = get_cached_response(key) if cache or CONFIG["cache_mode"] == "replay" else None
+    if cached is not None:
+        logging.info(f"Using cached Claude response {key[:12]}")
+        get_metrics().inc("claude_cache_total", kind=call_kind(system_prompt), result="hit")
+        return cached
+    if CONFIG["cache_mode"] != "off":
+        get_metrics().inc("claude_cache_total", kind=call_kind(system_prompt), result="miss")
+    if CONFIG["cache_mode"] == "replay":
+        raise CacheMiss(f"No cached response for {key[:12]} in replay mode")
+
+    params = claude_request_params(system_prompt, user_prompt, tools)
+    response = send_message(client, params)
+    result = response_text(response)
+
+    # Continue a max_tokens cut-off from where it stopped instead of regenerating
+    continuations = 0
+    while getattr(response, "stop_reason", None) == "max_tokens" and continuations < CONFIG["max_continuations"]:
+        continuations += 1
+        get_rate_limiter().count("continuations")
+        get_metrics().inc("claude_continuations_total", kind=call_kind(system_prompt))
+        logging.warning(f"Continuing truncated response ({len(result)} chars), "
+                        f"continuation {continuations}/{CONFIG['max_continuations']}")
+        result = result.rstrip()
+        follow_up = dict(params, messages=params["messages"] + [{"role": "assistant", "content": result}])
+        response = send_message(client, follow_up)
+        result += response_text(response)
+
+    put_cached_response(key, result)
+    return result
+
+
 # ---------------------------------------------------------------------------
 # City Data Management
 # ---------------------------------------------------------------------------
 
+def make_city_id(city_name: str, country: str) -> str:
+    """Id (data file stem) for a new city, e.g. "ho-chi-minh-city-vietnam"."""
+    return f"{city_name.lower().replace(' ', '-')}-{country.lower().replace(' ', '-')}"
+
+
+def city_key(city: dict) -> str:
+    """The id a city is stored under (its data file stem)."""
+    return city.get("city_id") or city.get("_city_id") or city.get("slug", "unknown")
+
+
+def _serialize_city(city_data: dict) -> str:
+    return json.dumps(city_data, indent=2, default=str, ensure_ascii=False)
+
+
+def _fingerprint(text: str) -> str:
+    """Content hash stored alongside a file's stats to tell a touched file from an edited one."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class CityStore:
+    """In-memory view of data/cities, loaded at most once per process.
+
+    Records are indexed by city_id, slug, country and region. save_city only
+    marks a record dirty; flush() writes dirty records whose serialized form
+    differs from what was last read from or written to disk.
+    """
+
+    def __init__(self, data_dir: Path):
+        self.data_dir = data_dir
+        self._cities: dict[str, dict] = {}
+        self._fingerprints: dict[str, str] = {}
+        self._index_keys: dict[str, tuple] = {}
+        self._dirty: set[str] = set()
+        self.written: set[str] = set()  # Ids flushed to disk by this process
+        self._loaded = False
+        self._lock = threading.RLock()
+        self.by_slug: dict[str, str] = {}
+        self.by_country: dict[str, set[str]] = defaultdict(set)
+        self.by_region: dict[str, set[str]] = defaultdict(set)
+
+    def _read(self, city_id: str) -> Optional[dict]:
+        path = self.data_dir / f"{city_id}.json"
+        if not path.exists():
+            return None
+        text = path.read_text(encoding="utf-8")
+        city = json.loads(text)
+        self._cities[city_id] = city
+        self._fingerprints[city_id] = _fingerprint(text)
+        self._index(city_id, city)
+        return city
+
+    def _index(self, city_id: str, city: dict):
+        self._unindex(city_id)
+        keys = (city.get("slug"), city.get("country"), city.get("regionSlug") or city.get("region"))
+        slug, country, region = keys
+        if slug:
+            owner = self.by_slug.setdefault(slug, city_id)
+            if owner != city_id:
+                logging.warning(f"Slug {slug!r} of {city_id} is already used by {owner}; "
+                                f"give one of them a slug of its own")
+        if country:
+            self.by_country[country].add(city_id)
+        if region:
+            self.by_region[region].add(city_id)
+        self._index_keys[city_id] = keys
+
+    def _unindex(self, city_id: str):
+        slug, country, region = self._index_keys.pop(city_id, (None, None, None))
+        if slug and self.by_slug.get(slug) == city_id:
+            del self.by_slug[slug]
+        self.by_country.get(country, set()).discard(city_id)
+        self.by_region.get(region, set()).discard(city_id)
+
+    @instrumented("city_store.load_all", io=True)
+    def load_all(self):
+        with self._lock:
+            if self._loaded:
+                return
+            if self.data_dir.exists():
+                for path in sorted(self.data_dir.glob("*.json")):
+                    if path.stem not in self._cities:
+                        self._read(path.stem)
+            self._loaded = True
+            logging.debug(f"Loaded {len(self._cities)} cities from {self.data_dir}")
+
+    def get(self, city_id: str) -> Optional[dict]:
+        with self._lock:
+            if city_id in self._cities:
+                return self._cities[city_id]
+            if self._loaded:
+                return None
+            return self._read(city_id)
+
+    def get_by_slug(self, slug: str) -> Optional[dict]:
+        self.load_all()
+        city_id = self.by_slug.get(slug)
+        return self._cities.get(city_id) if city_id else None
+
+    def slug_for(self, slug: str, city_id: str) -> str:
+        """slug, or city_id if another city already has that slug (e.g. Lagos, Nigeria/Portugal)."""
+        self.load_all()
+        owner = self.by_slug.get(slug)
+        return slug if owner in (None, city_id) else city_id
+
+    def in_country(self, country: str) -> list[dict]:
+        self.load_all()
+        return [self._cities[i] for i in sorted(self.by_country.get(country, ()))]
+
+    def in_region(self, region: str) -> list[dict]:
+        self.load_all()
+        return [self._cities[i] for i in sorted(self.by_region.get(region, ()))]
+
+    def all(self) -> list[dict]:
+        self.load_all()
+        return [self._cities[i] for i in sorted(self._cities)]
+
+    def put(self, city_data: dict):
+        with self._lock:
+            city_id = city_key(city_data)
+            self._cities[city_id] = city_data
+            self._index(city_id, city_data)
+            self._dirty.add(city_id)
+
+    @property
+    def dirty(self) -> set[str]:
+        return set(self._dirty)
+
+    @instrumented("city_store.flush", io=True)
+    def flush(self) -> int:
+        """Write dirty records that actually changed; return how many were written."""
+        with self._lock:
+            if not self._dirty:
+                return 0
+            self.data_dir.mkdir(parents=True, exist_ok=True)
+            written = 0
+            for city_id in sorted(self._dirty):
+                text = _serialize_city(self._cities[city_id])
+                fingerprint = _fingerprint(text)
+                if self._fingerprints.get(city_id) == fingerprint:
+                    continue
+                path = self.data_dir / f"{city_id}.json"
+                tmp = path.with_name(path.name + ".tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(text)
+                tmp.replace(path)
+                self._fingerprints[city_id] = fingerprint
+                self.written.add(city_id)
+                get_staleness_index().record(city_id, self._cities[city_id], fingerprint, path)
+                written += 1
+                logging.info(f"Saved city data: {city_id}")
+            skipped = len(self._dirty) - written
+            self._dirty.clear()
+            get_staleness_index().save()
+            if skipped:
+                logging.info(f"Skipped {skipped} unchanged city files")
+            return written
+
+
+_store: Optional[CityStore] = None
+
+
+def get_store() -> CityStore:
+    """The process-wide CityStore for CONFIG["data_dir"]."""
+    global _store
+    if _store is None or _store.data_dir != CONFIG["data_dir"]:
+        _store = CityStore(CONFIG["data_dir"])
+    return _store
+
+
 def load_city(city_id: str) -> Optional[dict]:
     """Load a city's data file."""
-    path = CONFIG["data_dir"] / f"{city_id}.json"
-    if path.exists():
-        with open(path) as f:
-            return json.load(f)
-    return None
+    return get_store().get(city_id)
 
 
 def save_city(city_data: dict):
-    """Save a city's data file."""
-    CONFIG["data_dir"].mkdir(parents=True, exist_ok=True)
-    city_id = city_data.get("city_id") or city_data.get("_city_id") or city_data.get("slug", "unknown")
-    path = CONFIG["data_dir"] / f"{city_id}.json"
-    with open(path, "w") as f:
-        json.dump(city_data, f, indent=2, default=str, ensure_ascii=False)
-    logging.info(f"Saved city data: {city_id}")
+    """Stage a city's data for the next CityStore flush."""
+    get_store().put(city_data)
+
+
+def flush_cities() -> int:
+    """Write every city saved since the last flush to data/cities."""
+    return get_store().flush()
 
 
 def get_all_cities() -> list[dict]:
     """Load all city data files."""
-    cities = []
-    if CONFIG["data_dir"].exists():
-        for file in CONFIG["data_dir"].glob("*.json"):
-            with open(file) as f:
-                cities.append(json.load(f))
-    return cities
+    return get_store().all()
+
+
+def parse_last_updated(city: dict) -> datetime:
+    """A city's last_updated/lastUpdated as an aware UTC datetime."""
+    date_str = city.get("last_updated") or city.get("lastUpdated", "2020-01-01")
+    try:
+        last_updated = datetime.fromisoformat(date_str.replace("Z", "+00:00"))
+    except (ValueError, AttributeError):
+        last_updated = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    if last_updated.tzinfo is None:
+        last_updated = last_updated.replace(tzinfo=timezone.utc)
+    return last_updated
+
+
+class StalenessIndex:
+    """Persistent city_id -> last-updated sidecar for data/cities.
+
+    Each entry records the file's mtime, size and content hash alongside the
+    parsed timestamp. refresh() only looks again at files whose mtime or size
+    moved. Those are read and hashed, and only the ones whose hash changed are
+    parsed; after a fresh CI checkout every mtime is new, but unchanged files
+    cost a read and a hash, not a JSON parse.
+    """
+
+    def __init__(self, path: Path, data_dir: Path):
+        self.path = path
+        self.data_dir = data_dir
+        self.entries: dict[str, dict] = {}
+        self._changed = False
+        if path.exists():
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logging.warning(f"Rebuilding unreadable staleness index {path}: {e}")
+
+    def refresh(self):
+        """Bring the index in line with data/cities using file stats."""
+        seen = set()
+        if self.data_dir.exists():
+            for path in self.data_dir.glob("*.json"):
+                city_id = path.stem
+                seen.add(city_id)
+                st = path.stat()
+                entry = self.entries.get(city_id)
+                if entry and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+                    continue
+                text = path.read_text(encoding="utf-8")
+                fingerprint = _fingerprint(text)
+                if entry and entry["hash"] == fingerprint:
+                    entry["mtime_ns"], entry["size"] = st.st_mtime_ns, st.st_size
+                    self._changed = True
+                    continue
+                self.record(city_id, json.loads(text), fingerprint, path)
+        for city_id in set(self.entries) - seen:
+            del self.entries[city_id]
+            self._changed = True
+        self.save()
+
+    def record(self, city_id: str, city: dict, fingerprint: str, path: Path):
+        """Update one entry after its file was read or written."""
+        st = path.stat()
+        self.entries[city_id] = {
+            "last_updated": parse_last_updated(city).timestamp(),
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+            "hash": fingerprint,
+        }
+        self._changed = True
+
+    def stalest(self, cutoff: Optional[datetime] = None, limit: Optional[int] = None) -> list[str]:
+        """City ids ordered oldest first, optionally only those older than cutoff."""
+        items = self.entries.items()
+        if cutoff is not None:
+            ts = cutoff.timestamp()
+            items = [(i, e) for i, e in items if e["last_updated"] < ts]
+        key = lambda item: (item[1]["last_updated"], item[0])
+        if limit is not None:
+            return [i for i, _ in heapq.nsmallest(limit, items, key=key)]
+        return [i for i, _ in sorted(items, key=key)]
+
+    @instrumented("staleness_index.save", io=True)
+    def save(self):
+        if not self._changed:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, separators=(",", ":"), sort_keys=True)
+        tmp.replace(self.path)
+        self._changed = False
 
 
-def get_stale_cities(threshold_days: int = None) -> list[dict]:
-    """Find cities whose data is older than threshold."""
+_staleness_index: Optional[StalenessIndex] = None
+
+
+def get_staleness_index() -> StalenessIndex:
+    global _staleness_index
+    if _staleness_index is None or _staleness_index.data_dir != CONFIG["data_dir"]:
+        _staleness_index = StalenessIndex(CONFIG["staleness_index_file"], CONFIG["data_dir"])
+    return _staleness_index
+
+
+def stale_city_ids(threshold_days: int = None, limit: int = None) -> list[str]:
+    """Ids of cities older than threshold, stalest first, from the sidecar index."""
     threshold = threshold_days or CONFIG["staleness_threshold_days"]
     cutoff = datetime.now(timezone.utc) - timedelta(days=threshold)
-    stale = []
-    for city in get_all_cities():
-        date_str = city.get("last_updated") or city.get("lastUpdated", "2020-01-01")
-        try:
-            last_updated = datetime.fromisoformat(date_str.replace("Z", "+00:00"))
-        except (ValueError, AttributeError):
-            last_updated = datetime(2020, 1, 1, tzinfo=timezone.utc)
-        if last_updated.tzinfo is None:
-            last_updated = last_updated.replace(tzinfo=timezone.utc)
-        if last_updated < cutoff:
-            stale.append(city)
-    return sorted(stale, key=lambda c: c.get("last_updated") or c.get("lastUpdated", "2020-01-01"))
+    index = get_staleness_index()
+    index.refresh()
+    return index.stalest(cutoff, limit)
+
+
+def get_stale_cities(threshold_days: int = None, limit: int = None) -> list[dict]:
+    """Find cities whose data is older than threshold, stalest first."""
+    cities = (load_city(city_id) for city_id in stale_city_ids(threshold_days, limit))
+    return [c for c in cities if c]
 
 
 def load_queue() -> list[dict]:
@@ -203,65 +1154,347 @@ def save_queue(queue: list):
         json.dump(queue, f, indent=2)
 
 
+class WorkQueue:
+    """SQLite-backed state for the add queue: pending, leased, done or failed.
+
+    city_queue.json stays the editable list of cities to add; sync() imports
+    it, with file order as the tie-break under an optional "priority" field.
+    Each item is leased before work starts and checkpointed as done or
+    failed right after it finishes, so a killed run resumes where it stopped.
+    Leases that expire (the process died) make the item available again.
+    Done items are never handed out again even if they reappear in the file.
+
+    The database is not tracked by git; CI carries it between runs with
+    actions/cache, like the staleness index. If it is lost, sync() rebuilds
+    it from city_queue.json, and cities whose file already exists are marked
+    done when leased, so only attempt counts are forgotten. It uses a
+    rollback journal rather than WAL so the one file is complete whenever
+    the process exits.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=DELETE")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS items (
+            city_id TEXT PRIMARY KEY,
+            entry TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            seq INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_until REAL,
+            last_error TEXT,
+            updated TEXT
+        )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS items_ready ON items (state, priority DESC, seq)")
+        self.db.commit()
+
+    @staticmethod
+    def entry_id(entry: dict) -> Optional[str]:
+        city_name = entry.get("name", entry.get("city", ""))
+        country = entry.get("country", "")
+        return make_city_id(city_name, country) if city_name and country else None
+
+    def _now(self) -> str:
+        return datetime.now(timezone.utc).isoformat()
+
+    def sync(self, queue: list[dict]):
+        """Import the queue file: add new entries, re-rank pending ones, drop removed ones.
+
+        A failed item listed again in the file gets a fresh set of attempts.
+        """
+        listed = set()
+        with self.db:
+            for seq, entry in enumerate(queue):
+                city_id = self.entry_id(entry)
+                if not city_id or city_id in listed:
+                    continue
+                listed.add(city_id)
+                self.db.execute(
+                    """INSERT INTO items (city_id, entry, priority, seq, updated) VALUES (?, ?, ?, ?, ?)
+                       ON CONFLICT(city_id) DO UPDATE SET
+                         entry = excluded.entry, priority = excluded.priority, seq = excluded.seq,
+                         attempts = CASE WHEN state = 'failed' THEN 0 ELSE attempts END,
+                         state = CASE WHEN state = 'failed' THEN 'pending' ELSE state END
+                       WHERE state IN ('pending', 'failed')""",
+                    (city_id, json.dumps(entry, ensure_ascii=False), int(entry.get("priority", 0)),
+                     seq, self._now()))
+            pending = [row[0] for row in self.db.execute("SELECT city_id FROM items WHERE state = 'pending'")]
+            self.db.executemany("DELETE FROM items WHERE city_id = ?",
+                                [(cid,) for cid in pending if cid not in listed])
+
+    def lease(self, limit: int, accept=None, minutes: float = None) -> list[tuple[str, dict]]:
+        """Claim up to limit pending or lease-expired items, highest priority first.
+
+        accept(city_id) can restrict the claim, e.g. to this worker's shard.
+        minutes overrides CONFIG["queue_lease_minutes"] for long-running work.
+        """
+        now = time.time()
+        minutes = CONFIG["queue_lease_minutes"] if minutes is None else minutes
+        with self.db:
+            ready = self.db.execute(
+                """SELECT city_id, entry FROM items
+                   WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?)
+                   ORDER BY priority DESC, seq""", (now,))
+            rows = []
+            for city_id, entry in ready:
+                if len(rows) >= limit:
+                    break
+                if accept is None or accept(city_id):
+                    rows.append((city_id, entry))
+            self.db.executemany(
+                """UPDATE items SET state = 'leased', attempts = attempts + 1,
+                   lease_until = ?, updated = ? WHERE city_id = ?""",
+                [(now + minutes * 60, self._now(), cid) for cid, _ in rows])
+        return [(cid, json.loads(entry)) for cid, entry in rows]
+
+    def complete(self, city_id: str):
+        with self.db:
+            self.db.execute("UPDATE items SET state = 'done', lease_until = NULL, last_error = NULL, "
+                            "updated = ? WHERE city_id = ?", (self._now(), city_id))
+
+    def fail(self, city_id: str, error: str) -> Optional[str]:
+        """Return the item to pending, or park it as failed once attempts run out.
+
+        Returns the new state, or None if the queue has no such item.
+        """
+        with self.db:
+            self.db.execute(
+                """UPDATE items SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                   lease_until = NULL, last_error = ?, updated = ? WHERE city_id = ?""",
+                (CONFIG["queue_max_attempts"], error[:500], self._now(), city_id))
+            row = self.db.execute("SELECT state FROM items WHERE city_id = ?", (city_id,)).fetchone()
+            return row[0] if row else None
+
+    def outstanding(self) -> list[dict]:
+        """Pending and leased entries in work order, for writing back to the queue file."""
+        rows = self.db.execute("SELECT entry FROM items WHERE state IN ('pending', 'leased') "
+                               "ORDER BY priority DESC, seq")
+        return [json.loads(entry) for (entry,) in rows]
+
+    def counts(self) -> dict[str, int]:
+        return dict(self.db.execute("SELECT state, COUNT(*) FROM items GROUP BY state"))
+
+    def close(self):
+        self.db.close()
+
+
+_work_queue: Optional[WorkQueue] = None
+
+
+def get_work_queue() -> WorkQueue:
+    global _work_queue
+    if _work_queue is None or _work_queue.path != CONFIG["work_queue_db"]:
+        if _work_queue is not None:
+            _work_queue.close()
+        _work_queue = WorkQueue(CONFIG["work_queue_db"])
+        atexit.register(_work_queue.close)
+    return _work_queue
+
+
 # ---------------------------------------------------------------------------
 # Changelog
 # ---------------------------------------------------------------------------
 
+class ChangelogWriter:
+    """Append-only JSONL changelog with batched fsync and size-based rotation.
+
+    The hot segment is CONFIG["changelog_jsonl"]; once it grows past
+    CONFIG["changelog_segment_bytes"] it is renamed to changelog.00001.jsonl,
+    changelog.00002.jsonl, ... and a fresh hot segment is started.
+    """
+
+    def __init__(self, path: Path, segment_bytes: int, fsync_every: int):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.fsync_every = fsync_every
+        self.appended = 0
+        self._pending = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def segments(self) -> list[Path]:
+        """All segments, oldest first, ending with the hot segment."""
+        rotated = sorted(self.path.parent.glob(f"{self.path.stem}.*{self.path.suffix}"))
+        return rotated + ([self.path] if self.path.exists() else [])
+
+    def append(self, entry: dict):
+        line = json.dumps(entry, default=str, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._open()
+            self._file.write(line)
+            self._file.flush()
+            self.appended += 1
+            self._pending += 1
+            if self._pending >= self.fsync_every:
+                self._sync()
+            if self._file.tell() >= self.segment_bytes:
+                self._rotate()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if not self.segments():
+            self._import_legacy()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _sync(self):
+        if self._pending:
+            os.fsync(self._file.fileno())
+            self._pending = 0
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        n = len(self.segments())  # hot segment included, so this is the next free index
+        self.path.rename(self.path.with_name(f"{self.path.stem}.{n:05d}{self.path.suffix}"))
+        self._file = open(self.path, "a", encoding="utf-8")
+        logging.info(f"Rotated changelog segment {n:05d}")
+
+    def _import_legacy(self):
+        """Seed the JSONL log from an existing changelog.json array, once."""
+        legacy = CONFIG["changelog_file"]
+        if not legacy.exists():
+            return
+        with open(legacy) as f:
+            entries = json.load(f)
+        with open(self.path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, default=str, ensure_ascii=False) + "\n")
+            os.fsync(f.fileno())
+        logging.info(f"Imported {len(entries)} legacy changelog entries into {self.path}")
+
+
+_changelog: Optional[ChangelogWriter] = None
+
+
+def get_changelog() -> ChangelogWriter:
+    global _changelog
+    if _changelog is None:
+        _changelog = ChangelogWriter(CONFIG["changelog_jsonl"],
+                                     CONFIG["changelog_segment_bytes"],
+                                     CONFIG["changelog_fsync_every"])
+        atexit.register(_changelog.close)
+    return _changelog
+
+
 def log_change(action: str, city_id: str, details: str):
     """Append to the changelog."""
-    CONFIG["changelog_file"].parent.mkdir(parents=True, exist_ok=True)
-    changelog = []
-    if CONFIG["changelog_file"].exists():
-        with open(CONFIG["changelog_file"]) as f:
-            changelog = json.load(f)
-
-    changelog.append({
+    get_changelog().append({
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "action": action,
         "city_id": city_id,
         "details": details,
     })
 
-    with open(CONFIG["changelog_file"], "w") as f:
-        json.dump(changelog, f, indent=2, default=str)
+
+def read_changelog():
+    """Yield every changelog entry, oldest first, across all segments."""
+    changelog = get_changelog()
+    segments = changelog.segments()
+    if not segments and CONFIG["changelog_file"].exists():
+        with open(CONFIG["changelog_file"]) as f:
+            yield from json.load(f)
+        return
+    for segment in segments:
+        with open(segment, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+@instrumented("changelog.export", io=True)
+def export_changelog():
+    """Write changelog.json, the whole log as one JSON array, from the JSONL segments.
+
+    This is O(n) in changelog size and the JSONL log is what gets committed,
+    so it only runs on demand (--mode export-changelog), never as part of a
+    pipeline run.
+    """
+    changelog = get_changelog()
+    changelog.close()
+    entries = list(read_changelog())
+    tmp = CONFIG["changelog_file"].with_suffix(".json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(entries, f, indent=2, default=str)
+    tmp.replace(CONFIG["changelog_file"])
+    logging.info(f"Exported {len(entries)} changelog entries to {CONFIG['changelog_file']}")
 
 
 # ---------------------------------------------------------------------------
 # Score Calculation
 # ---------------------------------------------------------------------------
 
-def calculate_overall_score(scores: dict) -> float:
-    """Calculate weighted overall safety score."""
-    total = 0
-    for category, weight in CATEGORY_WEIGHTS.items():
-        if category in scores:
-            val = scores[category]
-            # Handle both {"score": 75, ...} and plain 75
+def score_matrix(cities: list[dict], fields=None) -> np.ndarray:
+    """(cities x categories) float matrix; missing or non-numeric scores are NaN.
+
+    Category values may be plain numbers or legacy {"score": 75, ...} dicts.
+    """
+    fields = fields or SCORE_FIELDS
+    X = np.full((len(cities), len(fields)), np.nan)
+    for i, city in enumerate(cities):
+        scores = city.get("scores") or {}
+        for j, field in enumerate(fields):
+            val = scores.get(field)
             if isinstance(val, dict):
-                score_val = val.get("score", 0)
-            elif isinstance(val, (int, float)):
-                score_val = val
-            else:
-                score_val = 0
-            total += score_val * weight
-    return round(total, 1)
+                val = val.get("score")
+            if isinstance(val, (int, float)) and not isinstance(val, bool):
+                X[i, j] = val
+    return X
+
 
+def score_corpus(cities: list[dict], schema: str = None) -> tuple[np.ndarray, list[Optional[str]]]:
+    """Score every city at once; return (overall scores, tier ids).
 
-def determine_tier(score: float) -> tuple[str, str]:
+    Cities with none of the schema's categories get NaN and a None tier.
+    """
+    spec = SCORE_SCHEMAS[schema or CONFIG["score_schema"]]
+    weights = np.array(list(spec["weights"].values()), dtype=float)
+    X = score_matrix(cities, tuple(spec["weights"]))
+    present = ~np.isnan(X)
+    weight_sum = present @ weights
+    with np.errstate(invalid="ignore", divide="ignore"):
+        overall = np.round(np.where(present, X, 0.0) @ weights / weight_sum, 1)
+
+    floors = np.array([floor for floor, _, _ in spec["tiers"]][::-1])
+    tier_ids = [tier_id for _, tier_id, _ in spec["tiers"]][::-1]
+    positions = np.searchsorted(floors, np.nan_to_num(overall, nan=-np.inf), side="right") - 1
+    tiers = [tier_ids[max(p, 0)] if not np.isnan(o) else None for p, o in zip(positions, overall)]
+    return overall, tiers
+
+
+def calculate_overall_score(scores: dict, schema: str = None) -> float:
+    """Calculate weighted overall safety score for one scores dict."""
+    overall, _ = score_corpus([{"scores": scores}], schema)
+    return float(overall[0]) if not np.isnan(overall[0]) else 0.0
+
+
+def determine_tier(score: float, schema: str = None) -> tuple[str, str]:
     """Determine safety tier from score."""
-    for low, high, tier_id, tier_label in SAFETY_TIERS:
-        if low <= score <= high:
+    tiers = SCORE_SCHEMAS[schema or CONFIG["score_schema"]]["tiers"]
+    for floor, tier_id, tier_label in tiers:
+        if score >= floor:
             return tier_id, tier_label
-    return "moderate", "Moderate Risk"
+    return tiers[-1][1], tiers[-1][2]
 
 
 def calculate_trend(city_data: dict, new_score: float) -> str:
     """Determine if city safety is improving, stable, or declining."""
     old_score = city_data.get("overall_safety_score", new_score)
     diff = new_score - old_score
-    if diff >= 3:
+    delta = SCORE_SCHEMAS[CONFIG["score_schema"]]["trend_delta"]
+    if diff >= delta:
         return "improving"
-    elif diff <= -3:
+    elif diff <= -delta:
         return "declining"
     return "stable"
 
@@ -345,16 +1578,23 @@ REGION OPTIONS: South America, Central America & Caribbean, North America, South
 
 
 SYSTEM_PROMPT_REFRESH = """You are a travel safety data analyst updating existing city safety profiles.
-You have the current data and need to check for any changes.
+You have a summary of the current data and need to check for any changes.
 
 CRITICAL RULES:
 1. Search for the latest travel advisories, crime data, and safety events.
 2. Only change scores if there's evidence supporting the change.
-3. Document what changed and why in the revision notes.
+3. Document what changed and why in "revisionNotes".
 4. Flag any breaking safety events immediately.
-5. Update the "recent_incidents" section with anything from the last 90 days.
-
-OUTPUT FORMAT: You MUST respond with ONLY valid JSON matching the city schema.
+5. Scores are on a 1-10 scale where 10 = safest.
+6. NEVER include <cite> tags, citation markers, or any HTML tags in the text. Write plain text only.
+
+OUTPUT FORMAT: Respond with ONLY a JSON patch object containing the top-level fields that changed.
+- Omit every field that did not change. If nothing changed, respond with {"revisionNotes": "No changes"}.
+- Object fields (scores, health, emergency, transport, soloFemale, nightSafety) are merged: send only the changed keys.
+- neighborhoods and scams are patched by "name", faq by "q": send only changed or new items. A changed item needs its name (or q) plus the changed keys; a new item needs every key; {"name": "...", "remove": true} deletes one.
+- customs and relatedCities are replaced: send the complete new list.
+- Never send slug, name, country, countryCode, region, regionSlug or overallScore.
+Example: {"scores": {"pettyCrime": 5.5}, "summary": "New summary...", "revisionNotes": "Pickpocketing reports rose in 2026."}
 No markdown, no explanations — just the JSON object."""
 
 
@@ -375,14 +1615,11 @@ OUTPUT FORMAT: Respond with a JSON array of alerts:
 If no alerts, respond with: []"""
 
 
-def generate_city(client, city_name: str, country: str) -> dict:
-    """Generate a complete safety profile for a new city in site-ready format."""
-    logging.info(f"Generating new city profile: {city_name}, {country}")
-
-    city_id = f"{city_name.lower().replace(' ', '-')}-{country.lower().replace(' ', '-')}"
+def generate_city_prompt(city_name: str, country: str) -> str:
+    """User prompt asking Claude to research a new city."""
     slug = city_name.lower().replace(' ', '-')
 
-    prompt = f"""Research and generate a complete safety profile for {city_name}, {country}.
+    return f"""Research and generate a complete safety profile for {city_name}, {country}.
 
 Search for:
 1. Latest US State Department travel advisory for {country}
@@ -402,50 +1639,70 @@ Include exactly 6 neighborhoods, 3-4 scams, and 5 FAQ items.
 For relatedCities, use slugs of other cities in the same region.
 Remember: scores are on a 1-10 scale. Respond with ONLY the JSON object."""
 
+
+def parse_generated_city(response: str, city_name: str, country: str) -> dict:
+    """Turn a generate response into a sanitized, site-ready city record.
+
+    Raises if the response holds no usable JSON.
+    """
+    city_id = make_city_id(city_name, country)
+    slug = city_name.lower().replace(' ', '-')
+
+    city_data = extract_json(response, expect=dict)
+    # Ensure required fields exist
+    city_data["slug"] = city_data.get("slug", slug)
+    city_data["name"] = city_data.get("name", city_name)
+    city_data["country"] = city_data.get("country", country)
+
+    # Calculate overallScore from category scores if not present or wrong
+    if "scores" in city_data:
+        scores = city_data["scores"]
+        score_values = [v for v in scores.values() if isinstance(v, (int, float))]
+        if score_values:
+            city_data["overallScore"] = round(sum(score_values) / len(score_values), 1)
+
+    # Set badge based on score
+    score = city_data.get("overallScore", 5.0)
+    if score >= 7.0:
+        city_data["badgeClass"] = "safe"
+        city_data["badgeLabel"] = "Generally Safe"
+    elif score >= 5.0:
+        city_data["badgeClass"] = "caution"
+        city_data["badgeLabel"] = "Moderate Caution"
+    else:
+        city_data["badgeClass"] = "danger"
+        city_data["badgeLabel"] = "Exercise Caution"
+
+    # Also save to agent's data dir for tracking
+    city_data["_city_id"] = city_id
+    city_data["slug"] = get_store().slug_for(city_data["slug"], city_id)
+
+    # Sanitize the data
+    city_data = sanitize_city_data(city_data, city_name, country)
+
+    return city_data
+
+
+def generate_city(client, city_name: str, country: str) -> dict:
+    """Generate a complete safety profile for a new city in site-ready format."""
+    logging.info(f"Generating new city profile: {city_name}, {country}")
+
+    prompt = generate_city_prompt(city_name, country)
+
     max_retries = 2
     for attempt in range(max_retries + 1):
         if attempt > 0:
             logging.info(f"Retry {attempt}/{max_retries} for {city_name}")
-            import time
-            time.sleep(10)  # Brief pause before retry
 
         response = call_claude(client, SYSTEM_PROMPT_GENERATE, prompt, use_search=True)
 
         try:
-            city_data = extract_json(response)
-            # Ensure required fields exist
-            city_data["slug"] = city_data.get("slug", slug)
-            city_data["name"] = city_data.get("name", city_name)
-            city_data["country"] = city_data.get("country", country)
-
-            # Calculate overallScore from category scores if not present or wrong
-            if "scores" in city_data:
-                scores = city_data["scores"]
-                score_values = [v for v in scores.values() if isinstance(v, (int, float))]
-                if score_values:
-                    city_data["overallScore"] = round(sum(score_values) / len(score_values), 1)
-
-            # Set badge based on score
-            score = city_data.get("overallScore", 5.0)
-            if score >= 7.0:
-                city_data["badgeClass"] = "safe"
-                city_data["badgeLabel"] = "Generally Safe"
-            elif score >= 5.0:
-                city_data["badgeClass"] = "caution"
-                city_data["badgeLabel"] = "Moderate Caution"
-            else:
-                city_data["badgeClass"] = "danger"
-                city_data["badgeLabel"] = "Exercise Caution"
-
-            # Also save to agent's data dir for tracking
-            city_data["_city_id"] = city_id
-
-            # Sanitize the data
-            city_data = sanitize_city_data(city_data, city_name, country)
-
-            return city_data
+            return parse_generated_city(response, city_name, country)
         except Exception as e:
             logging.error(f"Failed to parse city data for {city_name} (attempt {attempt + 1}): {e}")
+            if isinstance(e, ValueError):  # No usable JSON (JSONDecodeError is a ValueError)
+                get_metrics().inc("claude_parse_failures_total", kind="generate")
+            evict_cached_response(SYSTEM_PROMPT_GENERATE, prompt)
             if attempt == max_retries:
                 logging.error(f"All retries exhausted for {city_name}")
                 logging.debug(f"Raw response: {response[:500]}")
@@ -453,87 +1710,214 @@ Remember: scores are on a 1-10 scale. Respond with ONLY the JSON object."""
 
 
 
+class WikipediaImageResolver:
+    """Wikipedia lead-image lookups with a persistent cache and batched queries.
+
+    Hits are cached indefinitely and misses for CONFIG["image_negative_ttl_days"].
+    Uncached titles are resolved up to 50 per MediaWiki request
+    (titles=A|B|C) over one keep-alive connection per thread.
+    """
+
+    MAX_TITLES = 50  # MediaWiki limit per query for anonymous clients
+
+    def __init__(self, api_url: str, cache_path: Path):
+        parts = urlsplit(api_url)
+        self.scheme, self.host, self.path = parts.scheme, parts.netloc, parts.path
+        self.cache_path = cache_path
+        self.cache: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._changed = False
+        if cache_path.exists():
+            try:
+                with open(cache_path) as f:
+                    self.cache = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                logging.warning(f"Ignoring unreadable image cache {cache_path}")
+
+    def _get(self, params: dict) -> dict:
+        conn = getattr(self._local, "conn", None)
+        for attempt in range(2):
+            if conn is None:
+                conn_class = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+                conn = self._local.conn = conn_class(self.host, timeout=10)
+            try:
+                conn.request("GET", f"{self.path}?{urlencode(params)}",
+                             headers={"User-Agent": "IsItSafeToVisit/1.0"})
+                resp = conn.getresponse()
+                body = resp.read()
+                if resp.status != 200:
+                    raise OSError(f"Wikipedia API returned HTTP {resp.status}")
+                return json.loads(body.decode())
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = self._local.conn = None
+                if attempt:
+                    raise
+        return {}
+
+    def _query(self, titles: list[str]) -> dict[str, str]:
+        """One API request for up to MAX_TITLES titles -> {requested title: image url or ""}."""
+        data = self._get({
+            "action": "query", "titles": "|".join(titles), "prop": "pageimages",
+            "format": "json", "pithumbsize": 1200, "redirects": 1,
+        })
+        query = data.get("query", {})
+        renamed = {m["from"]: m["to"] for m in query.get("normalized", []) + query.get("redirects", [])}
+        images = {}
+        for page in query.get("pages", {}).values():
+            thumb = page.get("thumbnail", {})
+            images[page.get("title")] = thumb["source"] if thumb.get("source") and thumb.get("width", 0) >= 400 else ""
+        results = {}
+        for title in titles:
+            resolved, seen = title, set()
+            while resolved in renamed and resolved not in seen:
+                seen.add(resolved)
+                resolved = renamed[resolved]
+            results[title] = images.get(resolved, "")
+        return results
+
+    def _cached(self, title: str) -> Optional[str]:
+        entry = self.cache.get(title)
+        if entry is None:
+            return None
+        if entry["url"]:
+            return entry["url"]
+        age_days = (datetime.now(timezone.utc).timestamp() - entry["checked"]) / 86400
+        return "" if age_days < CONFIG["image_negative_ttl_days"] else None
+
+    def lookup(self, titles: list[str]) -> dict[str, str]:
+        """Image url (or "") for each title, querying only uncached titles."""
+        with self._lock:
+            results = {t: self._cached(t) for t in dict.fromkeys(titles)}
+        missing = [t for t, url in results.items() if url is None]
+        for i in range(0, len(missing), self.MAX_TITLES):
+            chunk = missing[i:i + self.MAX_TITLES]
+            try:
+                fetched = self._query(chunk)
+            except Exception as e:
+                logging.warning(f"Wikipedia image lookup failed for {len(chunk)} titles: {e}")
+                fetched = {}
+            now = datetime.now(timezone.utc).timestamp()
+            with self._lock:
+                for title, url in fetched.items():
+                    self.cache[title] = {"url": url, "checked": now}
+                    self._changed = True
+            results.update({t: fetched.get(t, "") for t in chunk})
+        if missing:
+            self.save()
+        return results
+
+    def resolve(self, city_name: str, country: str) -> str:
+        """Best image for a city: "City, Country" first, then "City"."""
+        titles = [f"{city_name}, {country}", city_name]
+        found = self.lookup(titles)
+        return next((found[t] for t in titles if found[t]), "")
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_path.with_suffix(f".{threading.get_ident()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(self.cache, f, ensure_ascii=False)
+            tmp.replace(self.cache_path)
+            self._changed = False
+
+
+_image_resolver: Optional[WikipediaImageResolver] = None
+
+
+def get_image_resolver() -> WikipediaImageResolver:
+    global _image_resolver
+    if _image_resolver is None:
+        _image_resolver = WikipediaImageResolver(CONFIG["wikipedia_api"], CONFIG["image_cache_file"])
+    return _image_resolver
+
+
 def fetch_wikipedia_image(city_name: str, country: str) -> str:
     """Fetch the main Wikipedia image for a city."""
-    import urllib.request
-    import urllib.parse
-    
-    queries = [f"{city_name}, {country}", city_name]
-    for query in queries:
-        try:
-            encoded = urllib.parse.quote(query)
-            url = f"https://en.wikipedia.org/w/api.php?action=query&titles={encoded}&prop=pageimages&format=json&pithumbsize=1200&redirects=1"
-            req = urllib.request.Request(url, headers={"User-Agent": "IsItSafeToVisit/1.0"})
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                data = json.loads(resp.read().decode())
-            pages = data.get("query", {}).get("pages", {})
-            for page in pages.values():
-                thumb = page.get("thumbnail", {})
-                if thumb.get("source") and thumb.get("width", 0) >= 400:
-                    return thumb["source"]
-        except Exception:
-            continue
-    return ""
-
-def sanitize_city_data(city_data: dict, city_name: str, country: str) -> dict:
-    """Strip citation tags and ensure all required fields exist."""
-    import re
-
-    def strip_cites(obj):
-        """Recursively strip <cite> tags from all strings in the data."""
-        if isinstance(obj, str):
-            # Remove <cite ...>...</cite> tags but keep inner text
-            cleaned = re.sub(r'<cite[^>]*>(.*?)</cite>', r'\1', obj)
-            # Remove any remaining <cite> or </cite> tags
-            cleaned = re.sub(r'</?cite[^>]*>', '', cleaned)
-            return cleaned.strip()
-        elif isinstance(obj, dict):
-            return {k: strip_cites(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [strip_cites(item) for item in obj]
-        return obj
-
-    city_data = strip_cites(city_data)
+    return get_image_resolver().resolve(city_name, country)
+
+
+_CITE_PAIR = re.compile(r'<cite[^>]*>(.*?)</cite>')
+_CITE_TAG = re.compile(r'</?cite[^>]*>')
+
+
+def clean_text(text: str) -> str:
+    """Strip <cite> tags (keeping inner text) and surrounding whitespace."""
+    if "<" in text:
+        # Remove <cite ...>...</cite> tags but keep inner text
+        text = _CITE_PAIR.sub(r'\1', text)
+        # Remove any remaining <cite> or </cite> tags
+        text = _CITE_TAG.sub('', text)
+    return text.strip()
+
+
+def strip_cites(obj):
+    """Clean every string in a nested dict/list structure in place and return it."""
+    if isinstance(obj, str):
+        return clean_text(obj)
+    stack = [obj]
+    while stack:
+        container = stack.pop()
+        items = container.items() if isinstance(container, dict) else enumerate(container)
+        for key, value in items:
+            if isinstance(value, str):
+                cleaned = clean_text(value)
+                if cleaned is not value:
+                    container[key] = cleaned
+            elif isinstance(value, (dict, list)):
+                stack.append(value)
+    return obj
+
+
+# Builders for required fields, only called when a field is missing
+DEFAULT_FIELDS = {
+    "health": lambda city_name, country: {
+        "overview": f"Healthcare in {city_name} is adequate for travelers. Pharmacies are widely available.",
+        "water": "Check local advisories on tap water safety. Bottled water is widely available.",
+        "vaccinations": "Ensure routine vaccinations are up to date. Check CDC recommendations before travel.",
+        "altitude": f"Check local weather conditions before traveling to {city_name}."
+    },
+    "emergency": lambda city_name, country: {
+        "general": "112",
+        "police": "Check local emergency number",
+        "ambulance": "Check local emergency number",
+        "fire": "Check local emergency number",
+        "touristPolice": "N/A",
+        "usEmbassy": f"Contact the nearest US Embassy or Consulate in {country}"
+    },
+    "faq": lambda city_name, country: [
+        {"q": f"Is {city_name} safe for tourists?", "a": f"{city_name} is generally safe for tourists who take standard precautions. Be aware of your surroundings and follow local safety advice."},
+        {"q": f"Is {city_name} safe at night?", "a": f"Many areas of {city_name} are safe at night, but stick to well-lit, busy areas and use licensed transport."},
+        {"q": f"Is {city_name} safe for solo female travelers?", "a": f"Solo female travelers can visit {city_name} safely by following standard precautions and staying aware of their surroundings."},
+        {"q": f"What areas should I avoid in {city_name}?", "a": f"Check the neighborhood breakdown above for specific areas to exercise caution in {city_name}."},
+        {"q": f"Is it safe to use public transport in {city_name}?", "a": f"Public transport in {city_name} is generally safe. Keep your belongings secure and be alert during rush hours."}
+    ],
+    "relatedCities": lambda city_name, country: [],
+    "customs": lambda city_name, country: [f"Respect local customs and traditions in {city_name}.", "Learn a few basic phrases in the local language.", "Dress appropriately when visiting religious sites."],
+    "soloFemale": lambda city_name, country: {"overview": f"Solo female travel in {city_name} requires standard precautions.", "tips": ["Stay in well-reviewed accommodations.", "Share your itinerary with someone you trust.", "Trust your instincts in unfamiliar situations."]},
+    "nightSafety": lambda city_name, country: {"overview": f"Exercise standard nighttime precautions in {city_name}.", "tips": ["Stick to well-lit, populated areas.", "Use licensed taxis or rideshare apps.", "Avoid walking alone in unfamiliar areas late at night."]},
+    "neighborhoods": lambda city_name, country: [],
+    "scams": lambda city_name, country: [],
+    "transport": lambda city_name, country: {"metro": "Check local transit options.", "rideshare": "Uber and similar apps may be available.", "taxis": "Use licensed taxis.", "tips": "Plan your routes in advance."},
+}
 
-    # Ensure all required fields exist with defaults
-    defaults = {
-        "health": {
-            "overview": f"Healthcare in {city_name} is adequate for travelers. Pharmacies are widely available.",
-            "water": "Check local advisories on tap water safety. Bottled water is widely available.",
-            "vaccinations": "Ensure routine vaccinations are up to date. Check CDC recommendations before travel.",
-            "altitude": f"Check local weather conditions before traveling to {city_name}."
-        },
-        "emergency": {
-            "general": "112",
-            "police": "Check local emergency number",
-            "ambulance": "Check local emergency number",
-            "fire": "Check local emergency number",
-            "touristPolice": "N/A",
-            "usEmbassy": f"Contact the nearest US Embassy or Consulate in {country}"
-        },
-        "faq": [
-            {"q": f"Is {city_name} safe for tourists?", "a": f"{city_name} is generally safe for tourists who take standard precautions. Be aware of your surroundings and follow local safety advice."},
-            {"q": f"Is {city_name} safe at night?", "a": f"Many areas of {city_name} are safe at night, but stick to well-lit, busy areas and use licensed transport."},
-            {"q": f"Is {city_name} safe for solo female travelers?", "a": f"Solo female travelers can visit {city_name} safely by following standard precautions and staying aware of their surroundings."},
-            {"q": f"What areas should I avoid in {city_name}?", "a": f"Check the neighborhood breakdown above for specific areas to exercise caution in {city_name}."},
-            {"q": f"Is it safe to use public transport in {city_name}?", "a": f"Public transport in {city_name} is generally safe. Keep your belongings secure and be alert during rush hours."}
-        ],
-        "relatedCities": [],
-        "customs": [f"Respect local customs and traditions in {city_name}.", "Learn a few basic phrases in the local language.", "Dress appropriately when visiting religious sites."],
-        "soloFemale": {"overview": f"Solo female travel in {city_name} requires standard precautions.", "tips": ["Stay in well-reviewed accommodations.", "Share your itinerary with someone you trust.", "Trust your instincts in unfamiliar situations."]},
-        "nightSafety": {"overview": f"Exercise standard nighttime precautions in {city_name}.", "tips": ["Stick to well-lit, populated areas.", "Use licensed taxis or rideshare apps.", "Avoid walking alone in unfamiliar areas late at night."]},
-        "neighborhoods": [],
-        "scams": [],
-        "transport": {"metro": "Check local transit options.", "rideshare": "Uber and similar apps may be available.", "taxis": "Use licensed taxis.", "tips": "Plan your routes in advance."},
-    }
 
-    for field, default_val in defaults.items():
-        if field not in city_data or city_data[field] is None:
-            city_data[field] = default_val
+def sanitize_city_data(city_data: dict, city_name: str, country: str, fetch_image: bool = True) -> dict:
+    """Strip citation tags and ensure all required fields exist (in place)."""
+    strip_cites(city_data)
+
+    # Ensure all required fields exist with defaults
+    for field, build_default in DEFAULT_FIELDS.items():
+        if city_data.get(field) is None:
+            city_data[field] = build_default(city_name, country)
             logging.warning(f"Added missing field '{field}' for {city_name}")
 
     # Fetch Wikipedia image if not present
-    if not city_data.get("imageUrl"):
+    if fetch_image and CONFIG["fetch_images"] and not city_data.get("imageUrl"):
         try:
             img = fetch_wikipedia_image(city_name, country)
             if img:
@@ -545,23 +1929,57 @@ def sanitize_city_data(city_data: dict, city_name: str, country: str) -> dict:
     return city_data
 
 
-def refresh_city(client, city_data: dict) -> dict:
-    """Refresh an existing city's safety data."""
+def refresh_target(city_data: dict) -> Optional[tuple[str, str]]:
+    """(city_name, country) to research for a refresh, or None if unknown."""
     city_name = city_data.get("name", "")
     country = city_data.get("country", "")
-    city_id = city_data.get("city_id") or city_data.get("_city_id") or city_data.get("slug", "unknown")
+    city_id = city_key(city_data)
 
     if not city_name:
         city_name = city_id.replace("-", " ").title()
     if not country:
         logging.warning(f"No country found for {city_id}, skipping refresh")
-        return city_data
-
-    logging.info(f"Refreshing city: {city_name}, {country}")
+        return None
+    return city_name, country
+
+
+# Top-level fields a refresh patch may change; ids and derived scores are kept local.
+REFRESH_PATCH_FIELDS = (
+    "verdict", "badgeLabel", "badgeClass", "scores", "summary", "quickVerdict",
+    "neighborhoods", "scams", "soloFemale", "nightSafety", "transport", "customs",
+    "health", "emergency", "faq", "relatedCities",
+)
+
+# List fields patched item by item, matched on this key; other lists are replaced whole.
+REFRESH_LIST_KEYS = {"neighborhoods": "name", "scams": "name", "faq": "q"}
+
+
+def refresh_view(city_data: dict) -> dict:
+    """Compact summary of a city sent to Claude instead of the full record."""
+    view = {k: city_data[k] for k in (
+        "name", "country", "region", "lastUpdated", "overallScore", "verdict", "badgeLabel",
+        "scores", "summary", "quickVerdict", "emergency",
+    ) if k in city_data}
+    view["neighborhoods"] = [
+        {"name": n.get("name"), "score": n.get("score"), "class": n.get("class")}
+        for n in city_data.get("neighborhoods", []) if isinstance(n, dict)
+    ]
+    view["scams"] = [
+        {"name": sc.get("name"), "risk": sc.get("risk")}
+        for sc in city_data.get("scams", []) if isinstance(sc, dict)
+    ]
+    view["faq"] = [{"q": f.get("q")} for f in city_data.get("faq", []) if isinstance(f, dict)]
+    # Replaced whole by a patch, so sent whole
+    for field in ("customs", "relatedCities"):
+        if field in city_data:
+            view[field] = city_data[field]
+    return view
 
-    prompt = f"""Here is the current safety data for {city_name}, {country}:
 
-{json.dumps(city_data, indent=2, default=str)}
+def refresh_city_prompt(city_data: dict, city_name: str, country: str) -> str:
+    """User prompt asking Claude for a patch of changed fields."""
+    return f"""Current safety summary for {city_name}, {country}:
+{json.dumps(refresh_view(city_data), separators=(",", ":"), ensure_ascii=False, default=str)}
 
 Search for any updates since {city_data.get('last_updated', city_data.get('lastUpdated', 'unknown'))}:
 1. Has the travel advisory for {country} changed?
@@ -572,60 +1990,195 @@ Search for any updates since {city_data.get('last_updated', city_data.get('lastU
 6. Any new scam reports for {city_name}?
 7. Any changes to LGBTQ+ laws or safety in {country}?
 
-Update the JSON with any changes. Update lastUpdated to: "{datetime.now(timezone.utc).strftime('%Y-%m-%d')}"
-Respond with ONLY the updated JSON object. No markdown, no explanations."""
+Respond with ONLY a JSON patch of the fields that changed. No markdown, no explanations."""
+
 
+def validate_refresh_patch(patch: dict, city_data: dict) -> dict:
+    """Keep only patch fields that are allowed and shaped like the current values."""
+    clean = {}
+    for field, value in patch.items():
+        current = city_data.get(field)
+        if field not in REFRESH_PATCH_FIELDS or value is None:
+            logging.debug(f"Dropping refresh patch field '{field}'")
+            continue
+        if current is not None and not (
+            isinstance(value, type(current))
+            or (isinstance(value, (int, float)) and isinstance(current, (int, float)))
+        ):
+            logging.warning(f"Dropping refresh patch field '{field}': expected {type(current).__name__}")
+            continue
+        if field == "scores":
+            value = {k: v for k, v in value.items()
+                     if isinstance(v, (int, float)) and 1 <= v <= 10
+                     and (not current or k in current)}
+        elif field in REFRESH_LIST_KEYS:
+            value = validate_list_patch(field, value, current or [])
+            if not value:
+                continue
+        elif isinstance(value, list) and current and isinstance(current[0], dict):
+            required = set(current[0])
+            if not all(isinstance(item, dict) and required <= set(item) for item in value):
+                logging.warning(f"Dropping refresh patch field '{field}': incomplete list items")
+                continue
+        clean[field] = value
+    return clean
+
+
+def validate_list_patch(field: str, items: list, current: list) -> list:
+    """Keep the items of a keyed list patch that are removals, edits of an
+    existing item, or complete new items.
+    """
+    key = REFRESH_LIST_KEYS[field]
+    existing = {item.get(key) for item in current if isinstance(item, dict)}
+    required = next((set(item) for item in current if isinstance(item, dict)), {key})
+    clean = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get(key), str):
+            logging.warning(f"Dropping '{field}' patch item without a '{key}'")
+        elif item.get(key) not in existing and (item.get("remove") or not required <= set(item)):
+            logging.warning(f"Dropping '{field}' patch item {item[key]!r}: unknown or incomplete")
+        else:
+            clean.append(item)
+    return clean
+
+
+def apply_refresh_patch(city_data: dict, patch: dict) -> dict:
+    """A copy of city_data with object fields merged, keyed lists patched item
+    by item and other fields replaced.
+    """
+    updated = json.loads(json.dumps(city_data, default=str))
+    for field, value in patch.items():
+        if field in REFRESH_LIST_KEYS:
+            key = REFRESH_LIST_KEYS[field]
+            items = [item for item in updated.get(field) or [] if isinstance(item, dict)]
+            by_key = {item.get(key): item for item in items}
+            for change in value:
+                if change.pop("remove", False):
+                    items = [item for item in items if item.get(key) != change[key]]
+                elif change[key] in by_key:
+                    by_key[change[key]].update(change)
+                else:
+                    items.append(change)
+                    by_key[change[key]] = change
+            updated[field] = items
+        elif isinstance(value, dict) and isinstance(updated.get(field), dict):
+            updated[field].update(value)
+        else:
+            updated[field] = value
+    updated["lastUpdated"] = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    return updated
+
+
+def parse_refreshed_city(response: str, city_data: dict, city_name: str, country: str) -> dict:
+    """Apply a refresh patch response and return the sanitized record.
+
+    Raises if the response holds no usable JSON object.
+    """
+    patch = extract_json(response, expect=dict)
+    if not isinstance(patch, dict):
+        raise ValueError(f"Expected a JSON patch object, got {type(patch).__name__}")
+    notes = patch.pop("revisionNotes", None)
+    if notes:
+        logging.info(f"Revision notes for {city_name}: {notes}")
+
+    clean = validate_refresh_patch(patch, city_data)
+    logging.info(f"Refresh patch for {city_name} changes {sorted(clean) or 'nothing'}")
+    updated_data = apply_refresh_patch(city_data, clean)
+
+    # Handle scoring for both formats
+    if "scores" in updated_data:
+        scores = updated_data["scores"]
+        score_values = [v for v in scores.values() if isinstance(v, (int, float))]
+        if score_values:
+            updated_data["overallScore"] = round(sum(score_values) / len(score_values), 1)
+
+    # Sanitize
+    updated_data = sanitize_city_data(updated_data, city_name, country)
+    return updated_data
+
+
+def refresh_city(client, city_data: dict) -> dict:
+    """Refresh an existing city's safety data."""
+    target = refresh_target(city_data)
+    if target is None:
+        return city_data
+    city_name, country = target
+
+    logging.info(f"Refreshing city: {city_name}, {country}")
+
+    prompt = refresh_city_prompt(city_data, city_name, country)
     response = call_claude(client, SYSTEM_PROMPT_REFRESH, prompt, use_search=True)
 
     try:
-        updated_data = extract_json(response)
-        # Preserve the city_id/slug
-        if "city_id" in city_data:
-            updated_data["city_id"] = city_data["city_id"]
-        if "_city_id" in city_data:
-            updated_data["_city_id"] = city_data["_city_id"]
-        if "slug" in city_data:
-            updated_data["slug"] = city_data["slug"]
-
-        # Handle scoring for both formats
-        if "scores" in updated_data:
-            scores = updated_data["scores"]
-            score_values = [v for v in scores.values() if isinstance(v, (int, float))]
-            if score_values:
-                updated_data["overallScore"] = round(sum(score_values) / len(score_values), 1)
-
-        # Sanitize
-        updated_data = sanitize_city_data(updated_data, city_name, country)
-        return updated_data
+        return parse_refreshed_city(response, city_data, city_name, country)
     except Exception as e:
         logging.error(f"Failed to refresh {city_name}: {e}")
+        if isinstance(e, ValueError):  # No usable JSON patch
+            get_metrics().inc("claude_parse_failures_total", kind="refresh")
+        evict_cached_response(SYSTEM_PROMPT_REFRESH, prompt)
         return city_data  # Return unchanged data on failure
 
 
-def check_alerts(client, cities: list[dict]) -> list[dict]:
-    """Check for breaking safety events across all cities."""
-    logging.info(f"Checking alerts for {len(cities)} cities")
+ALERT_SEVERITY_ORDER = {"critical": 0, "high": 1, "medium": 2, "low": 3}
+
 
-    # Handle both old format (city_id) and new format (name/country)
-    city_names = []
-    for c in cities[:50]:
+def load_alert_state() -> dict[str, str]:
+    """city_id -> ISO timestamp of its last successful alert check."""
+    if CONFIG["alert_state_file"].exists():
+        with open(CONFIG["alert_state_file"]) as f:
+            return json.load(f)
+    return {}
+
+
+def save_alert_state(state: dict[str, str]):
+    CONFIG["alert_state_file"].parent.mkdir(parents=True, exist_ok=True)
+    with open(CONFIG["alert_state_file"], "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+def build_alert_shards(cities: list[dict], shard_size: int) -> list[list[dict]]:
+    """Partition cities into prompt-sized shards of whole countries within a region.
+
+    Keeping a country's cities together lets one advisory search cover all
+    of them; a country larger than shard_size is split across shards.
+    """
+    grouped = defaultdict(lambda: defaultdict(list))
+    for c in cities:
+        region = c.get("regionSlug") or c.get("region") or ""
+        grouped[region][c.get("country", "")].append(c)
+
+    shards = []
+    for region in sorted(grouped):
+        current = []
+        for country in sorted(grouped[region]):
+            group = grouped[region][country]
+            if current and len(current) + len(group) > shard_size:
+                shards.append(current)
+                current = []
+            for i in range(0, len(group), shard_size):
+                chunk = group[i:i + shard_size]
+                if len(current) + len(chunk) > shard_size:
+                    shards.append(current)
+                    current = []
+                current.extend(chunk)
+        if current:
+            shards.append(current)
+    return shards
+
+
+def alert_shard_prompt(shard: list[dict]) -> str:
+    """User prompt listing a shard's cities grouped by country, with their ids."""
+    by_country = defaultdict(list)
+    for c in shard:
         name = c.get('name', '')
-        country = c.get('country', '')
         if not name:
-            # Try to extract from city_id or slug
-            city_id = c.get('city_id', c.get('slug', ''))
-            name = city_id.replace('-', ' ').title() if city_id else 'Unknown'
-        if name and name != 'Unknown':
-            city_names.append(f"{name} ({country})" if country else name)
-
-    if not city_names:
-        logging.info("No valid cities to check alerts for")
-        return []
-
-    city_list = ", ".join(city_names)
+            # Handle both old format (city_id) and new format (name/country)
+            name = city_key(c).replace('-', ' ').title()
+        by_country[c.get('country', '') or 'Unknown country'].append(f"{name} [{city_key(c)}]")
+    city_list = "\n".join(f"- {country}: {', '.join(names)}" for country, names in by_country.items())
 
-    prompt = f"""Check for any breaking safety events in the last 48 hours
-that would affect travelers in these cities:
+    return f"""Check for any breaking safety events in the last 48 hours
+that would affect travelers in these cities (city_id in brackets):
 
 {city_list}
 
@@ -635,25 +2188,86 @@ Search for:
 3. Natural disasters
 4. Terrorism or major crime events
 5. Disease outbreaks
-6. Airport closures or transport disruptions"""
+6. Airport closures or transport disruptions
 
-    response = call_claude(client, SYSTEM_PROMPT_ALERT, prompt, use_search=True)
+Use the bracketed city_id in each alert. A country-wide event should produce
+one alert per affected city listed above."""
 
-    try:
-        alerts = extract_json(response)
-        if isinstance(alerts, list):
-            return alerts
-    except Exception:
-        pass
-    return []
+
+def check_alert_shard(client, shard: list[dict]) -> list[dict]:
+    """Alerts for one shard, with city_ids resolved against the shard's cities."""
+    response = call_claude(client, SYSTEM_PROMPT_ALERT, alert_shard_prompt(shard),
+                           use_search=True, cache=False)
+    alerts = [a for a in extract_json(response, expect=list)
+              if isinstance(a, dict) and isinstance(a.get("city_id"), str)]
+
+    ids = {city_key(c) for c in shard}
+    by_name = {c.get("name", "").lower(): city_key(c) for c in shard if c.get("name")}
+    for alert in alerts:
+        city_id = alert["city_id"]
+        if city_id not in ids and city_id.lower() in by_name:
+            alert["city_id"] = by_name[city_id.lower()]
+    return alerts
+
+
+def merge_alerts(alerts: list[dict]) -> list[dict]:
+    """Deduplicate alerts by (city_id, alert_type), keeping the most severe."""
+    merged = {}
+    for alert in alerts:
+        key = (alert.get("city_id", "unknown"), alert.get("alert_type", "").lower())
+        rank = ALERT_SEVERITY_ORDER.get(alert.get("severity"), len(ALERT_SEVERITY_ORDER))
+        if key not in merged or rank < ALERT_SEVERITY_ORDER.get(merged[key].get("severity"), rank + 1):
+            merged[key] = alert
+    return sorted(merged.values(),
+                  key=lambda a: ALERT_SEVERITY_ORDER.get(a.get("severity"), len(ALERT_SEVERITY_ORDER)))
+
+
+def check_alerts(client, cities: list[dict]) -> list[dict]:
+    """Check for breaking safety events across all cities.
+
+    Cities are split into shards. A shard is due when one of its cities would
+    go past CONFIG["alert_sla_hours"] without a check before the next run,
+    CONFIG["alert_run_interval_hours"] from now. Each run sends at most its
+    share of the rotation, ceil(shards * interval / SLA), most overdue first,
+    on the worker pool, so the checks spread evenly over the runs in an SLA
+    window. A city's check time only advances when its shard succeeds.
+    """
+    state = load_alert_state()
+    now = datetime.now(timezone.utc)
+    interval = CONFIG["alert_run_interval_hours"]
+    due_cutoff = (now - timedelta(hours=CONFIG["alert_sla_hours"] - interval)).isoformat()
+
+    shards = build_alert_shards(cities, CONFIG["alert_shard_size"])
+    budget = math.ceil(len(shards) * interval / CONFIG["alert_sla_hours"])
+    oldest = lambda shard: min(state.get(city_key(c), "") for c in shard)
+    due = sorted((s for s in shards if oldest(s) < due_cutoff), key=oldest)
+    logging.info(f"Checking alerts for {len(cities)} cities: {len(due)}/{len(shards)} shards due, "
+                 f"sending {min(len(due), budget)} (budget {budget} per run)")
+    due = due[:budget]
+
+    if not due:
+        logging.info(f"Every city was alert-checked within the last {CONFIG['alert_sla_hours']}h")
+        return []
+
+    alerts = []
+    checked_at = now.isoformat()
+    for shard, shard_alerts in run_concurrently(lambda s: check_alert_shard(client, s), due, "alerts"):
+        if shard_alerts is None:
+            continue
+        alerts.extend(shard_alerts)
+        for c in shard:
+            state[city_key(c)] = checked_at
+
+    save_alert_state(state)
+    return merge_alerts(alerts)
 
 
 def recalculate_rankings(cities: list[dict]) -> list[dict]:
-    """Recalculate and sort all city rankings."""
-    for city in cities:
-        if "scores" in city:
-            city["overall_safety_score"] = calculate_overall_score(city["scores"])
-            tier_id, _ = determine_tier(city["overall_safety_score"])
+    """Recalculate and sort all city rankings, scoring the corpus in one pass."""
+    overall, tiers = score_corpus(cities)
+    for city, score, tier_id in zip(cities, overall.tolist(), tiers):
+        if tier_id is not None:
+            city["overall_safety_score"] = score
             city["safety_tier"] = tier_id
 
     ranked = sorted(cities, key=lambda c: c.get("overall_safety_score", 0), reverse=True)
@@ -663,68 +2277,608 @@ def recalculate_rankings(cities: list[dict]) -> list[dict]:
     return ranked
 
 
+# ---------------------------------------------------------------------------
+# Ranking History
+# ---------------------------------------------------------------------------
+
+class RankingHistory:
+    """Append-only columnar history of ranking runs, one row per city per run.
+
+    Every rank run appends one line to runs.jsonl holding its date and its
+    city, score and rank columns; cities.json maps the integer city column
+    to city ids, one id per line. Both files only grow at the end, so a run
+    commits as a small text diff. On open the runs are concatenated into
+    numpy columns. Runs are appended in time order, so the day column is
+    sorted and date lookups are binary searches. A line cut short by a crash
+    is dropped on open. Every run is recorded, including runs that change
+    nothing, so trend windows span calendar days rather than changed runs.
+    """
+
+    COLUMNS = {"run": np.uint32, "day": np.int32, "city": np.uint32,
+               "score": np.float32, "rank": np.uint32}
+    EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+    def __init__(self, history_dir: Path):
+        self.history_dir = history_dir
+        self.runs_file = history_dir / "runs.jsonl"
+        self.city_ids: list[str] = []
+        cities_file = history_dir / "cities.json"
+        if cities_file.exists():
+            with open(cities_file) as f:
+                self.city_ids = json.load(f)
+        self.city_index = {cid: i for i, cid in enumerate(self.city_ids)}
+        parts = {name: [] for name in self.COLUMNS}
+        if self.runs_file.exists():
+            data = self.runs_file.read_bytes()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                logging.warning(f"Dropping a partial ranking history line in {self.runs_file}")
+                os.truncate(self.runs_file, end)
+            for line in data[:end].splitlines():
+                record = json.loads(line)
+                n = len(record["city"])
+                parts["run"].append(np.full(n, record["run"]))
+                parts["day"].append(np.full(n, self.to_day(
+                    datetime.strptime(record["date"], "%Y-%m-%d").replace(tzinfo=timezone.utc))))
+                for name in ("city", "score", "rank"):
+                    parts[name].append(record[name])
+        self._columns = {name: np.concatenate(parts[name]).astype(dtype) if parts[name]
+                         else np.empty(0, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+        self.rows = len(self._columns["run"])
+
+    def column(self, name: str) -> np.ndarray:
+        return self._columns[name]
+
+    @classmethod
+    def to_day(cls, when: datetime) -> int:
+        return (when.astimezone(timezone.utc) - cls.EPOCH).days
+
+    @classmethod
+    def from_day(cls, day: int) -> str:
+        return (cls.EPOCH + timedelta(days=int(day))).strftime("%Y-%m-%d")
+
+    @instrumented("ranking_history.append", io=True)
+    def append(self, ranked: list[dict], when: datetime = None) -> int:
+        """Record one ranking run; return its run number."""
+        rows = [c for c in ranked if isinstance(c.get("overall_safety_score"), (int, float))]
+        if not rows:
+            return -1
+        run = int(self.column("run")[-1]) + 1 if self.rows else 0
+        day = self.to_day(when or datetime.now(timezone.utc))
+        if self.rows:
+            day = max(day, int(self.column("day")[-1]))  # Keep the day column sorted
+        known = len(self.city_ids)
+        for city in rows:
+            cid = city_key(city)
+            if cid not in self.city_index:
+                self.city_index[cid] = len(self.city_ids)
+                self.city_ids.append(cid)
+
+        self.history_dir.mkdir(parents=True, exist_ok=True)
+        if len(self.city_ids) > known:
+            tmp = self.history_dir / "cities.json.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.city_ids, f, indent=0)  # One id per line, so new ids diff as added lines
+            tmp.replace(self.history_dir / "cities.json")
+
+        values = {
+            "run": np.full(len(rows), run),
+            "day": np.full(len(rows), day),
+            "city": [self.city_index[city_key(c)] for c in rows],
+            "score": [c["overall_safety_score"] for c in rows],
+            "rank": [c.get("global_rank", 0) for c in rows],
+        }
+        record = {"run": run, "date": self.from_day(day), "city": values["city"],
+                  "score": values["score"], "rank": values["rank"]}
+        with open(self.runs_file, "a") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        for name, dtype in self.COLUMNS.items():
+            self._columns[name] = np.concatenate([self._columns[name], np.asarray(values[name], dtype=dtype)])
+        self.rows += len(rows)
+        return run
+
+    def city_series(self, city_id: str) -> list[dict]:
+        """Every recorded run for one city, oldest first."""
+        idx = self.city_index.get(city_id)
+        if idx is None or not self.rows:
+            return []
+        rows = np.flatnonzero(self.column("city") == idx)
+        return [{"date": self.from_day(d), "score": round(float(s), 1), "rank": int(r)}
+                for d, s, r in zip(self.column("day")[rows], self.column("score")[rows],
+                                   self.column("rank")[rows])]
+
+    def on_date(self, date: str) -> dict[str, dict]:
+        """Scores and ranks from the last run on or before date (YYYY-MM-DD)."""
+        if not self.rows:
+            return {}
+        day = self.to_day(datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc))
+        end = int(np.searchsorted(self.column("day"), day, side="right"))
+        if end == 0:
+            return {}
+        run = self.column("run")[end - 1]
+        start = int(np.searchsorted(self.column("run")[:end], run, side="left"))
+        return {self.city_ids[c]: {"score": round(float(s), 1), "rank": int(r)}
+                for c, s, r in zip(self.column("city")[start:end], self.column("score")[start:end],
+                                   self.column("rank")[start:end])}
+
+    def trends(self, window_days: int = None, delta: float = None) -> dict[str, str]:
+        """improving/declining/stable per city from the least-squares slope of
+        score over the last window_days, scaled to the change across the window.
+        """
+        window_days = window_days or CONFIG["trend_window_days"]
+        if delta is None:
+            delta = SCORE_SCHEMAS[CONFIG["score_schema"]]["trend_delta"]
+        if not self.rows:
+            return {}
+        days = self.column("day")
+        start = int(np.searchsorted(days, int(days[-1]) - window_days, side="left"))
+        city = np.asarray(self.column("city")[start:], dtype=np.int64)
+        x = np.asarray(days[start:], dtype=float)
+        y = np.asarray(self.column("score")[start:], dtype=float)
+        x -= x.mean()  # Centre for numerical stability
+
+        n_cities = len(self.city_ids)
+        n = np.bincount(city, minlength=n_cities)
+        sx = np.bincount(city, x, n_cities)
+        sy = np.bincount(city, y, n_cities)
+        sxx = np.bincount(city, x * x, n_cities)
+        sxy = np.bincount(city, x * y, n_cities)
+        denom = n * sxx - sx * sx
+        with np.errstate(invalid="ignore", divide="ignore"):
+            change = np.where(denom > 0, (n * sxy - sx * sy) / denom, 0.0) * window_days
+
+        result = {}
+        for i in np.flatnonzero(n):
+            if change[i] >= delta:
+                result[self.city_ids[i]] = "improving"
+            elif change[i] <= -delta:
+                result[self.city_ids[i]] = "declining"
+            else:
+                result[self.city_ids[i]] = "stable"
+        return result
+
+
+_ranking_history: Optional[RankingHistory] = None
+
+
+def get_ranking_history() -> RankingHistory:
+    global _ranking_history
+    if _ranking_history is None or _ranking_history.history_dir != CONFIG["ranking_history_dir"]:
+        _ranking_history = RankingHistory(CONFIG["ranking_history_dir"])
+    return _ranking_history
+
+
 # ---------------------------------------------------------------------------
 # Utilities
 # ---------------------------------------------------------------------------
 
-def extract_json(text: str) -> dict | list:
-    """Extract JSON from Claude's response, handling various formats."""
-    import re
+_json_decoder = json.JSONDecoder()
+_JSON_START = re.compile(r"[\[{]")
 
+
+def iter_json_candidates(text: str):
+    """Yield (start, end, value) for each JSON object/array embedded in text.
+
+    One left-to-right pass: raw_decode is tried at each '{' or '[', and a
+    successful decode skips straight past the value, so braces inside
+    strings and nested containers are never re-scanned.
+    """
+    pos = 0
+    while True:
+        match = _JSON_START.search(text, pos)
+        if not match:
+            return
+        try:
+            value, end = _json_decoder.raw_decode(text, match.start())
+        except json.JSONDecodeError:
+            pos = match.start() + 1
+            continue
+        yield match.start(), end, value
+        pos = end
+
+
+def salvage_truncated_json(text: str, expect: type = None):
+    """Best-effort parse of a JSON value cut off mid-stream (e.g. at max_tokens).
+
+    Cuts the text back to the last member boundary that still parses and
+    closes any open containers. Returns None if the value starting at the
+    first opener is actually closed (so not truncated) or nothing parses.
+    """
+    opener = {dict: "{", list: "["}.get(expect)
+    if opener:
+        start = text.find(opener)
+    else:
+        match = _JSON_START.search(text)
+        start = match.start() if match else -1
+    if start == -1:
+        return None
+
+    stack = []
+    cuts = []
+    in_string = escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append(ch)
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                return None
+            cuts.append((i + 1, "".join(stack)))
+        elif ch == ",":
+            cuts.append((i, "".join(stack)))
+
+    for pos, open_stack in reversed(cuts[-50:]):
+        closers = "".join("}" if c == "{" else "]" for c in reversed(open_stack))
+        try:
+            value = json.loads(text[start:pos] + closers)
+        except json.JSONDecodeError:
+            continue
+        if expect is None or isinstance(value, expect):
+            return value
+    return None
+
+
+def extract_json(text: str, expect: type = None) -> dict | list:
+    """Extract JSON from Claude's response, handling various formats.
+
+    Tries the whole text, then salvages a value cut off mid-stream, then
+    falls back to the largest embedded object/array (fenced or
+    prose-wrapped output). Pass expect=dict or expect=list to skip values
+    of the wrong type.
+    """
     cleaned = text.strip()
+    kinds = expect or (dict, list)
 
     # Try direct parse first
     try:
-        return json.loads(cleaned)
+        value = json.loads(cleaned)
+        if isinstance(value, kinds):
+            return value
     except json.JSONDecodeError:
         pass
 
-    # Try stripping markdown code fences
-    fence_pattern = re.compile(r'```(?:json)?\s*\n?(.*?)\n?\s*```', re.DOTALL)
-    match = fence_pattern.search(cleaned)
-    if match:
-        try:
-            return json.loads(match.group(1).strip())
-        except json.JSONDecodeError:
-            pass
-
-    # Try finding JSON object by matching braces
-    brace_start = cleaned.find('{')
-    if brace_start != -1:
-        depth = 0
-        for i in range(brace_start, len(cleaned)):
-            if cleaned[i] == '{':
-                depth += 1
-            elif cleaned[i] == '}':
-                depth -= 1
-                if depth == 0:
-                    try:
-                        return json.loads(cleaned[brace_start:i + 1])
-                    except json.JSONDecodeError:
-                        break
-
-    # Try finding JSON array by matching brackets
-    bracket_start = cleaned.find('[')
-    if bracket_start != -1:
-        depth = 0
-        for i in range(bracket_start, len(cleaned)):
-            if cleaned[i] == '[':
-                depth += 1
-            elif cleaned[i] == ']':
-                depth -= 1
-                if depth == 0:
-                    try:
-                        return json.loads(cleaned[bracket_start:i + 1])
-                    except json.JSONDecodeError:
-                        break
+    candidates = [(start, end, value) for start, end, value in iter_json_candidates(cleaned)
+                  if isinstance(value, kinds)]
+
+    # Complete values nested inside a truncated one must not win over it
+    first_opener = _JSON_START.search(cleaned)
+    if first_opener and first_opener.start() not in {start for start, _, _ in candidates}:
+        salvaged = salvage_truncated_json(cleaned, expect)
+        if salvaged is not None:
+            logging.warning(f"Salvaged truncated JSON from a {len(cleaned)}-char response")
+            return salvaged
+
+    if candidates:
+        return max(candidates, key=lambda c: c[1] - c[0])[2]
 
     raise json.JSONDecodeError("No valid JSON found in response", cleaned, 0)
 
 
+# ---------------------------------------------------------------------------
+# Concurrency
+# ---------------------------------------------------------------------------
+
+def run_concurrently(func, items: list, label: str = "task"):
+    """Run func over items on a bounded thread pool.
+
+    Yields (item, result) pairs in completion order, not queue order, so
+    callers can save, checkpoint and log each one from the main thread
+    without locking and without waiting on a slower item submitted earlier. A failure in one item
+    is logged and yields None for that item instead of aborting the whole batch.
+    """
+    workers = max(1, min(CONFIG["max_workers"], len(items)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=label) as pool:
+        futures = {pool.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                yield item, future.result()
+            except Exception as e:
+                logging.error(f"{label} failed for {item!r:.80}: {e}")
+                yield item, None
+
+
+# ---------------------------------------------------------------------------
+# Message Batches
+# ---------------------------------------------------------------------------
+
+def load_pending_batches() -> list[dict]:
+    """Message Batches submitted but not yet collected."""
+    if CONFIG["batches_file"].exists():
+        with open(CONFIG["batches_file"]) as f:
+            return json.load(f)
+    return []
+
+
+def save_pending_batches(batches: list[dict]):
+    CONFIG["batches_file"].parent.mkdir(parents=True, exist_ok=True)
+    with open(CONFIG["batches_file"], "w") as f:
+        json.dump(batches, f, indent=2)
+
+
+@instrumented("batch_submit")
+def run_batch_submit(client):
+    """Submit the next add and refresh workloads as a single Message Batch.
+
+    Queue entries are leased from the work queue for CONFIG["batch_lease_hours"]
+    and recorded with the batch in CONFIG["batches_file"]; run_batch_collect
+    marks them done or failed.
+    """
+    pending = load_pending_batches()
+    in_flight = {item["city_id"] for b in pending for item in b["items"].values()}
+
+    requests = []
+    items = {}
+
+    def add_request(kind: str, system_prompt: str, prompt: str, item: dict):
+        custom_id = f"{kind}-{len(requests)}"
+        tools = claude_tools(True)
+        requests.append({"custom_id": custom_id,
+                         "params": claude_request_params(system_prompt, prompt, tools)})
+        item["kind"] = kind
+        item["cache_key"] = response_cache_key(system_prompt, prompt, tools)
+        items[custom_id] = item
+
+    work_queue = get_work_queue()
+    work_queue.sync(load_queue())
+    leased = work_queue.lease(CONFIG["message_batch_size_add"], accept=lambda cid: cid not in in_flight,
+                              minutes=CONFIG["batch_lease_hours"] * 60)
+    added = 0
+    for city_id, entry in leased:
+        if load_city(city_id) is not None:
+            work_queue.complete(city_id)
+            continue
+        city_name, country = entry.get("name", entry.get("city", "")), entry.get("country", "")
+        add_request("add", SYSTEM_PROMPT_GENERATE, generate_city_prompt(city_name, country),
+                    {"city_id": city_id, "name": city_name, "country": country, "entry": entry})
+        added += 1
+
+    refreshed = 0
+    for city_id in stale_city_ids():
+        if refreshed >= CONFIG["message_batch_size_refresh"]:
+            break
+        city = load_city(city_id)
+        target = refresh_target(city) if city and city_id not in in_flight else None
+        if target is None:
+            continue
+        city_name, country = target
+        add_request("refresh", SYSTEM_PROMPT_REFRESH, refresh_city_prompt(city, city_name, country),
+                    {"city_id": city_id, "name": city_name, "country": country})
+        refreshed += 1
+
+    if not requests:
+        logging.info("Nothing to submit: queue empty and no stale cities outside pending batches")
+        return None
+
+    try:
+        batch = api_call(client.messages.batches.create, requests=requests)
+    except Exception as e:
+        for item in items.values():
+            if item["kind"] == "add":
+                work_queue.fail(item["city_id"], f"batch submit failed: {e}")
+        raise
+    pending.append({
+        "batch_id": batch.id,
+        "submitted": datetime.now(timezone.utc).isoformat(),
+        "items": items,
+    })
+    save_pending_batches(pending)
+    save_queue(work_queue.outstanding())
+    logging.info(f"Submitted Message Batch {batch.id}: {added} adds, {refreshed} refreshes")
+    log_change("batch_submit", "all", f"Batch {batch.id}: {added} adds, {refreshed} refreshes")
+    return batch.id
+
+
+@instrumented("batch_collect")
+def run_batch_collect(client):
+    """Parse, sanitize, save and publish the results of every finished Message Batch."""
+    pending = load_pending_batches()
+    if not pending:
+        logging.info("No pending Message Batches")
+        return
+
+    work_queue = get_work_queue()
+    still_pending = []
+    published = []
+    for record in pending:
+        batch_id = record["batch_id"]
+        batch = api_call(client.messages.batches.retrieve, batch_id)
+        if batch.processing_status != "ended":
+            logging.info(f"Message Batch {batch_id} still {batch.processing_status}")
+            still_pending.append(record)
+            continue
+
+        requeue = []
+        failed = 0
+        succeeded = 0
+
+        def fail(item: dict, error: str):
+            nonlocal failed
+            failed += 1
+            if item["kind"] != "add":
+                return
+            if work_queue.fail(item["city_id"], error) is None:
+                # Submitted before adds went through the work queue
+                requeue.append(item["entry"])
+
+        # Read the whole JSONL stream inside the retry, not lazily in the loop
+        results = api_call(lambda: list(client.messages.batches.results(batch_id)))
+        for result in results:
+            item = record["items"].get(result.custom_id)
+            if item is None:
+                continue
+            name, country = item["name"], item["country"]
+            if result.result.type != "succeeded":
+                logging.error(f"Batch {batch_id} {item['kind']} {name} {result.result.type}")
+                fail(item, f"batch result {result.result.type}")
+                continue
+
+            kind = "generate" if item["kind"] == "add" else "refresh"
+            record_claude_usage(kind, getattr(result.result.message, "usage", None), batch=True)
+            text = response_text(result.result.message)
+            put_cached_response(item["cache_key"], text)
+            try:
+                if item["kind"] == "add":
+                    city_data = parse_generated_city(text, name, country)
+                    save_city(city_data)
+                    flush_cities()
+                    work_queue.complete(item["city_id"])
+                    published.append(city_data)
+                    log_change("add", item["city_id"],
+                               f"New city added with score {city_data.get('overallScore', '?')}")
+                else:
+                    city = load_city(item["city_id"])
+                    if city is None:
+                        continue
+                    updated = parse_refreshed_city(text, city, name, country)
+                    save_city(updated)
+                    flush_cities()
+                    published.append(updated)
+                    log_change("refresh", item["city_id"],
+                               f"Score: {city.get('overallScore', '?')} → {updated.get('overallScore', '?')}")
+                succeeded += 1
+            except Exception as e:
+                logging.error(f"Failed to parse batch result for {name}: {e}")
+                if isinstance(e, ValueError):
+                    get_metrics().inc("claude_parse_failures_total", kind=kind)
+                fail(item, f"unparseable batch result: {e}")
+
+        flush_cities()
+        save_queue(work_queue.outstanding() + requeue)
+        logging.info(f"Collected Message Batch {batch_id}: {succeeded} saved, {failed} failed")
+
+    save_pending_batches(still_pending)
+    if published:
+        merge_into_site_data(published)
+
+
+# ---------------------------------------------------------------------------
+# Sharding
+# ---------------------------------------------------------------------------
+
+def parse_shard(spec: str) -> tuple[int, int]:
+    """Parse --shard "i/N" (0 <= i < N)."""
+    try:
+        index, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {spec!r}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be in 0..{count - 1}, got {spec!r}")
+    return index, count
+
+
+def shard_of(city_id: str, count: int) -> int:
+    """Stable shard for a city id; sha1 so it doesn't depend on PYTHONHASHSEED."""
+    return int.from_bytes(hashlib.sha1(city_id.encode("utf-8")).digest()[:8], "big") % count
+
+
+def in_shard(city_id: str) -> bool:
+    if CONFIG["shard"] is None:
+        return True
+    index, count = CONFIG["shard"]
+    return shard_of(city_id, count) == index
+
+
+def shard_output_dir(index: int, count: int) -> Path:
+    return CONFIG["shard_dir"] / f"shard-{index}-of-{count}"
+
+
+def configure_shard(index: int, count: int):
+    """Send this worker's changelog and run report to its shard directory; city files are
+    copied there by write_shard_output when the run ends.
+    """
+    CONFIG["shard"] = (index, count)
+    out = shard_output_dir(index, count)
+    out.mkdir(parents=True, exist_ok=True)
+    CONFIG["changelog_jsonl"] = out / "changelog.jsonl"
+    CONFIG["changelog_file"] = out / "changelog.json"
+    CONFIG["run_report_file"] = out / "run_report.json"
+    CONFIG["metrics_textfile"] = out / "agent.prom"
+
+
+def write_shard_output():
+    """Copy the city files this worker wrote into its shard directory."""
+    index, count = CONFIG["shard"]
+    out = shard_output_dir(index, count)
+    (out / "cities").mkdir(parents=True, exist_ok=True)
+    written = sorted(get_store().written)
+    for city_id in written:
+        shutil.copy2(CONFIG["data_dir"] / f"{city_id}.json", out / "cities" / f"{city_id}.json")
+    with open(out / "manifest.json", "w") as f:
+        json.dump({"shard": index, "count": count, "cities": written,
+                   "finished": datetime.now(timezone.utc).isoformat()}, f, indent=2)
+    logging.info(f"Shard {index}/{count}: wrote {len(written)} cities to {out}")
+
+
+@instrumented("merge_shards")
+def run_merge_shards() -> int:
+    """Combine every shard directory into data/cities, the changelog and the site data.
+
+    Shards own disjoint city ids, so city files never conflict; if
+    directories from runs with different shard counts are present, the
+    most recently finished one wins. Changelog entries are interleaved by
+    timestamp. Merged shard directories are removed, so re-running is a no-op.
+    """
+    shard_dirs = []
+    for out in CONFIG["shard_dir"].glob("shard-*-of-*"):
+        manifest_path = out / "manifest.json"
+        if not manifest_path.exists():
+            logging.warning(f"Skipping {out}: no manifest (worker did not finish)")
+            continue
+        with open(manifest_path) as f:
+            shard_dirs.append((json.load(f), out))
+    if not shard_dirs:
+        logging.info("No shard outputs to merge")
+        return 0
+    shard_dirs.sort(key=lambda item: item[0]["finished"])
+
+    merged = {}
+    entries = []
+    for manifest, out in shard_dirs:
+        for city_id in manifest["cities"]:
+            with open(out / "cities" / f"{city_id}.json", encoding="utf-8") as f:
+                merged[city_id] = json.load(f)
+        shard_log = ChangelogWriter(out / "changelog.jsonl", 0, 0)
+        for segment in shard_log.segments():
+            with open(segment, encoding="utf-8") as f:
+                entries.extend(json.loads(line) for line in f if line.strip())
+
+    for city in merged.values():
+        save_city(city)
+    flush_cities()
+    for entry in sorted(entries, key=lambda e: e.get("timestamp", "")):
+        get_changelog().append(entry)
+
+    work_queue = get_work_queue()
+    work_queue.sync(load_queue())
+    for city_id in merged:
+        work_queue.complete(city_id)
+    save_queue(work_queue.outstanding())
+
+    if merged:
+        merge_into_site_data(list(merged.values()))
+    for _, out in shard_dirs:
+        shutil.rmtree(out)
+    logging.info(f"Merged {len(shard_dirs)} shards: {len(merged)} cities, {len(entries)} changelog entries")
+    return len(merged)
+
+
 # ---------------------------------------------------------------------------
 # Pipeline Modes
 # ---------------------------------------------------------------------------
 
+@instrumented("full")
 def run_full_pipeline(client):
     """Run the complete pipeline: refresh stale + add new + recalculate."""
     logging.info("=" * 60)
@@ -737,8 +2891,9 @@ def run_full_pipeline(client):
     # Step 2: Add new cities from queue
     run_add_cities(client)
 
-    # Step 3: Recalculate all rankings
+    # Step 3: Recalculate all rankings, then related cities + aggregates
     run_rankings()
+    run_site_aggregates()
 
     # Step 4: Check for alerts
     run_alerts(client)
@@ -746,195 +2901,686 @@ def run_full_pipeline(client):
     logging.info("FULL PIPELINE COMPLETE")
 
 
+@instrumented("refresh")
 def run_refresh(client):
     """Refresh stale cities."""
-    stale = get_stale_cities()
-    batch = stale[: CONFIG["batch_size_refresh"]]
-    logging.info(f"Found {len(stale)} stale cities, refreshing {len(batch)}")
+    stale = [city_id for city_id in stale_city_ids() if in_shard(city_id)]
+    batch = [c for c in map(load_city, stale[: CONFIG["batch_size_refresh"]]) if c]
+    logging.info(f"Found {len(stale)} stale cities, refreshing {len(batch)} "
+                 f"({CONFIG['max_workers']} workers)")
 
-    for city in batch:
-        updated = refresh_city(client, city)
+    refreshed = []
+    for city, updated in run_concurrently(lambda c: refresh_city(client, c), batch, "refresh"):
         if updated:
+            # Flush each city as it lands so a killed run keeps what it paid for
             save_city(updated)
-            city_id = city.get("city_id") or city.get("_city_id") or city.get("slug", "unknown")
+            flush_cities()
+            refreshed.append(updated)
+            city_id = city_key(city)
             log_change("refresh", city_id,
                        f"Score: {city.get('overall_safety_score', city.get('overallScore', '?'))} → {updated.get('overall_safety_score', updated.get('overallScore', '?'))}")
 
+    flush_cities()
+    if refreshed:
+        merge_into_site_data(refreshed)
 
-def run_add_cities(client):
-    """Add new cities from the queue and merge into site's city-data.json."""
-    queue = load_queue()
-    batch = queue[: CONFIG["batch_size_add"]]
-    remaining = queue[CONFIG["batch_size_add"]:]
-    logging.info(f"Queue has {len(queue)} cities, adding {len(batch)}")
 
-    new_cities = []
-    for entry in batch:
-        city_name = entry.get("name", entry.get("city", ""))
-        country = entry.get("country", "")
-        if not city_name or not country:
+@instrumented("add")
+def run_add_cities(client):
+    """Add new cities from the queue and merge them into the site data.
+
+    Items are leased from the work queue and checkpointed one by one (city
+    file flushed, then marked done), so an interrupted run resumes with the
+    cities it had not finished.
+    """
+    work_queue = get_work_queue()
+    work_queue.sync(load_queue())
+    batch = work_queue.lease(CONFIG["batch_size_add"], accept=in_shard)
+    logging.info(f"Queue state {work_queue.counts()}, adding {len(batch)} "
+                 f"({CONFIG['max_workers']} workers)")
+
+    entries = []
+    for city_id, entry in batch:
+        if load_city(city_id) is not None:
+            # Already generated by a run that died before checkpointing
+            work_queue.complete(city_id)
             continue
+        entries.append((city_id, entry.get("name", entry.get("city", "")), entry.get("country", "")))
 
-        city_data = generate_city(client, city_name, country)
-        if city_data:
-            # Save to agent's data dir
-            save_city(city_data)
-            new_cities.append(city_data)
-            city_id = city_data.get("_city_id", city_data.get("slug", "unknown"))
-            log_change("add", city_id,
-                       f"New city added with score {city_data.get('overallScore', '?')}")
-
-    save_queue(remaining)
+    new_cities = []
+    try:
+        for (city_id, city_name, _), city_data in run_concurrently(
+                lambda e: generate_city(client, e[1], e[2]), entries, "generate"):
+            if city_data:
+                # Save to agent's data dir, then checkpoint the queue item
+                save_city(city_data)
+                flush_cities()
+                work_queue.complete(city_id)
+                new_cities.append(city_data)
+                log_change("add", city_key(city_data),
+                           f"New city added with score {city_data.get('overallScore', '?')}")
+            else:
+                state = work_queue.fail(city_id, "generation failed")
+                logging.warning(f"Could not generate {city_name}; queue item now {state}")
+    finally:
+        if CONFIG["shard"] is None:
+            save_queue(work_queue.outstanding())
 
-    # Merge new cities into the site's city-data.json
+    # Publish new cities to the site data
     if new_cities:
         merge_into_site_data(new_cities)
 
 
-def merge_into_site_data(new_cities: list[dict]):
-    """Merge new city data into the site's src/lib/city-data.json."""
-    site_data_path = Path("./src/lib/city-data.json")
+# Region slugs the regions pages fold into another region
+REGION_SLUG_ALIASES = {"central-america-caribbean": "central-america", "west-africa": "africa"}
+
+INDEX_FIELDS = ("slug", "name", "country", "countryCode", "region", "regionSlug",
+                "lastUpdated", "overallScore", "badgeLabel", "badgeClass")
 
-    # Load existing site data
-    if site_data_path.exists():
-        with open(site_data_path) as f:
+
+def country_slug(country: str) -> str:
+    """Same as toSlug() in src/app/countries/[slug]/page.tsx."""
+    return re.sub(r"[^a-z0-9-]", "", re.sub(r"\s+", "-", country.lower()))
+
+
+def region_slug(slug: str) -> str:
+    return REGION_SLUG_ALIASES.get(slug, slug)
+
+
+def _write_json_if_changed(path: Path, obj) -> bool:
+    """Write minified JSON atomically unless the file already holds the same bytes."""
+    data = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+    if path.exists() and path.stat().st_size == len(data) and path.read_bytes() == data:
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    tmp.replace(path)
+    return True
+
+
+def _aggregate(slug: str, name: str, entries: list[dict]) -> dict:
+    """Summary block for a country or region page, cities sorted safest first."""
+    entries = sorted(entries, key=lambda e: -(e.get("overallScore") or 0))
+    scores = [e["overallScore"] for e in entries if isinstance(e.get("overallScore"), (int, float))]
+    return {
+        "slug": slug,
+        "name": name,
+        "cityCount": len(entries),
+        "averageScore": round(sum(scores) / len(scores), 1) if scores else 0,
+        "cities": entries,
+    }
+
+
+class SiteDataPublisher:
+    """Incremental publisher for the site data under src/lib/site-data.
+
+    The per-city shards are the source of truth. index.json holds the compact
+    card fields for every city plus country and region summaries;
+    cities/<slug>.json holds one full record; countries/<slug>.json and
+    regions/<slug>.json hold the cards for one page. Loading reads only
+    index.json, upsert() compares a city against its own shard, and write()
+    rewrites the shards of changed cities, the groups they belong to (or
+    moved out of) and the index, so a refresh costs the same whatever the
+    corpus size. src/lib/city-data.json, which the Next.js app imports, is
+    assembled from the shards by build-city-data.js before `next build`.
+
+    Each card records the city id that publishes it, and a slug stays with
+    that city. redirects.json maps slugs a city moved away from to its
+    current slug, so old /cities/<slug> URLs keep working.
+    """
+
+    def __init__(self, shard_dir: Path, legacy_file: Path = None):
+        self.dir = shard_dir
+        self.metadata: dict = {}
+        self.entries: dict[str, dict] = {}  # slug -> card, in publish order
+        self.pending: dict[str, dict] = {}  # slug -> record upserted since the last write()
+        self.removed: set[str] = set()      # Slugs whose city moved away since the last write()
+        self.redirects: dict[str, str] = {}  # Old slug -> current slug
+        # Country/region slugs a changed city moved out of since the last write()
+        self.vacated_countries: set[str] = set()
+        self.vacated_regions: set[str] = set()
+        index_path = shard_dir / "index.json"
+        if index_path.exists():
+            with open(index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            self.metadata = index.get("metadata", {})
+            self.entries = {e["slug"]: e for e in index.get("cities", []) if e.get("slug")}
+        elif legacy_file is not None and legacy_file.exists():
+            self._import_legacy(legacy_file)
+        if (shard_dir / "redirects.json").exists():
+            with open(shard_dir / "redirects.json", encoding="utf-8") as f:
+                self.redirects = json.load(f)
+        # City id -> the slug it is published under
+        self.slugs = {e["cityId"]: slug for slug, e in self.entries.items() if e.get("cityId")}
+
+    def _import_legacy(self, path: Path):
+        """Seed the shards from a monolithic city-data.json, once."""
+        with open(path, encoding="utf-8") as f:
             site_data = json.load(f)
-    else:
-        site_data = {"cities": []}
-
-    # Handle both formats: {"cities": [...]} or just [...]
-    if isinstance(site_data, dict) and "cities" in site_data:
-        cities_list = site_data["cities"]
-    elif isinstance(site_data, list):
-        cities_list = site_data
-        site_data = {"cities": cities_list}
-    else:
-        cities_list = []
-        site_data = {"cities": cities_list}
+        # Handle both formats: {"cities": [...]} or just [...]
+        if isinstance(site_data, list):
+            site_data = {"cities": site_data}
+        elif not isinstance(site_data, dict) or not isinstance(site_data.get("cities"), list):
+            site_data = {"cities": []}
+        if isinstance(site_data.get("metadata"), dict):
+            self.metadata = site_data["metadata"]
+        store = get_store()
+        store.load_all()
+        for city in site_data["cities"]:
+            if city.get("slug"):
+                self.entries[city["slug"]] = self.card(city, store.by_slug.get(city["slug"]))
+                self.pending[city["slug"]] = city
+        logging.info(f"Seeding {len(self.pending)} site data shards from {path}")
+
+    @staticmethod
+    def card(city: dict, city_id: Optional[str]) -> dict:
+        card = {k: city[k] for k in INDEX_FIELDS if k in city}
+        if city_id:
+            card["cityId"] = city_id
+        return card
+
+    def published(self, slug: str) -> Optional[dict]:
+        """The full record currently published under slug, if any."""
+        if slug in self.pending:
+            return self.pending[slug]
+        path = self.dir / "cities" / f"{slug}.json"
+        if slug not in self.entries or not path.exists():
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
 
-    existing_slugs = {c.get("slug") for c in cities_list}
+    def _move(self, city_id: str, old_slug: str, slug: str):
+        """Drop the record a city published under old_slug and redirect old_slug to slug."""
+        previous = self.entries.pop(old_slug)
+        self.pending.pop(old_slug, None)
+        self.removed.add(old_slug)
+        self.vacated_countries.add(country_slug(previous.get("country", "")))
+        self.vacated_regions.add(region_slug(previous.get("regionSlug", "")))
+        for source, target in self.redirects.items():
+            if target == old_slug:
+                self.redirects[source] = slug
+        self.redirects[old_slug] = slug
+        logging.warning(f"{city_id} moved from /cities/{old_slug} to /cities/{slug}; "
+                        f"redirecting the old URL")
+        log_change("redirect", city_id, f"/cities/{old_slug} -> /cities/{slug}")
+
+    def upsert(self, cities: list[dict]) -> tuple[int, int]:
+        """Add new cities and replace changed ones; return (added, updated).
+
+        A city whose slug changed has its old record dropped and its old slug
+        redirected. A slug published by another city is never taken over.
+        """
+        added = updated = 0
+        for city in cities:
+            # Remove internal tracking fields
+            clean_city = {k: v for k, v in city.items() if not k.startswith("_")}
+            slug = clean_city.get("slug", "")
+            if not slug:
+                continue
+            city_id = city_key(city)
+            owner = self.entries.get(slug, {}).get("cityId", city_id)
+            if owner != city_id:
+                # Same slug, different city: never overwrite another city's published record
+                logging.error(f"Slug {slug!r} is published for {owner}; "
+                              f"not publishing {city_id} over it")
+                continue
+            old_slug = self.slugs.get(city_id, slug)
+            if old_slug != slug:
+                self._move(city_id, old_slug, slug)
+                updated += 1
+            elif slug in self.entries:
+                if self.published(slug) == clean_city:
+                    continue
+                previous = self.entries[slug]
+                self.vacated_countries.add(country_slug(previous.get("country", "")))
+                self.vacated_regions.add(region_slug(previous.get("regionSlug", "")))
+                updated += 1
+                logging.info(f"Updated site data: {clean_city.get('name', slug)}")
+            else:
+                added += 1
+                logging.info(f"Merged into site data: {clean_city.get('name', slug)}")
+            self.entries[slug] = self.card(clean_city, city_id)
+            self.pending[slug] = clean_city
+            self.slugs[city_id] = slug
+            self.removed.discard(slug)
+            self.redirects.pop(slug, None)  # The slug serves a city again
+        return added, updated
+
+    @instrumented("site_data.write", io=True)
+    def write(self) -> int:
+        """Write pending city shards, the groups they touch and index.json; return files written.
+
+        A group left empty by a city moving out has its file removed.
+        """
+        countries = defaultdict(list)
+        regions = defaultdict(list)
+        country_names = {}
+        touched_countries = set(self.vacated_countries)
+        touched_regions = set(self.vacated_regions)
+        written = 0
+        for slug, city in self.pending.items():
+            written += _write_json_if_changed(self.dir / "cities" / f"{slug}.json", city)
+            touched_countries.add(country_slug(city.get("country", "")))
+            touched_regions.add(region_slug(city.get("regionSlug", "")))
+        for slug in self.removed:
+            path = self.dir / "cities" / f"{slug}.json"
+            if path.exists():
+                path.unlink()
+                written += 1
+        written += _write_json_if_changed(self.dir / "redirects.json", dict(sorted(self.redirects.items())))
+        for entry in self.entries.values():
+            c_slug = country_slug(entry.get("country", ""))
+            r_slug = region_slug(entry.get("regionSlug", ""))
+            if c_slug:
+                countries[c_slug].append(entry)
+                country_names.setdefault(c_slug, entry["country"])
+            if r_slug:
+                regions[r_slug].append(entry)
+
+        country_summaries = []
+        for slug, members in sorted(countries.items()):
+            aggregate = _aggregate(slug, country_names[slug], members)
+            aggregate["countryCode"] = members[0].get("countryCode", "")
+            aggregate["regionSlug"] = region_slug(members[0].get("regionSlug", ""))
+            if slug in touched_countries:
+                written += _write_json_if_changed(self.dir / "countries" / f"{slug}.json", aggregate)
+            country_summaries.append({k: v for k, v in aggregate.items() if k != "cities"})
+
+        region_summaries = []
+        for slug, members in sorted(regions.items()):
+            aggregate = _aggregate(slug, members[0].get("region", slug), members)
+            if slug in touched_regions:
+                written += _write_json_if_changed(self.dir / "regions" / f"{slug}.json", aggregate)
+            region_summaries.append({k: v for k, v in aggregate.items() if k != "cities"})
+
+        for group, members, touched in (("countries", countries, touched_countries),
+                                        ("regions", regions, touched_regions)):
+            for slug in touched - set(members) - {""}:
+                path = self.dir / group / f"{slug}.json"
+                if path.exists():
+                    path.unlink()
+                    written += 1
+
+        # lastUpdated is the newest city's date, so an unchanged corpus gives an unchanged index
+        self.metadata.update(totalCities=len(self.entries),
+                             lastUpdated=max((e.get("lastUpdated", "") for e in self.entries.values()),
+                                             default=""))
+        written += _write_json_if_changed(self.dir / "index.json", {
+            "metadata": self.metadata,
+            "cities": list(self.entries.values()),
+            "countries": country_summaries,
+            "regions": region_summaries,
+        })
+        self.pending.clear()
+        self.removed.clear()
+        self.vacated_countries.clear()
+        self.vacated_regions.clear()
+        return written
+
+
+_site_publisher: Optional[SiteDataPublisher] = None
+
+
+def get_site_publisher() -> SiteDataPublisher:
+    global _site_publisher
+    if _site_publisher is None or _site_publisher.dir != CONFIG["site_shards_dir"]:
+        _site_publisher = SiteDataPublisher(CONFIG["site_shards_dir"], CONFIG["site_data_file"])
+    return _site_publisher
+
+
+def merge_into_site_data(cities: list[dict]):
+    """Upsert added or refreshed cities into the site data shards."""
+    if CONFIG["shard"] is not None:
+        logging.info(f"Shard run: leaving {len(cities)} cities for merge-shards to publish")
+        return
+    publisher = get_site_publisher()
+    added, updated = publisher.upsert(cities)
 
-    added = 0
-    for city in new_cities:
-        # Remove internal tracking fields
-        clean_city = {k: v for k, v in city.items() if not k.startswith("_")}
-        slug = clean_city.get("slug", "")
-
-        if slug and slug not in existing_slugs:
-            cities_list.append(clean_city)
-            existing_slugs.add(slug)
-            added += 1
-            logging.info(f"Merged into site data: {clean_city.get('name', slug)}")
-        elif slug in existing_slugs:
-            logging.info(f"City already exists in site data, skipping: {slug}")
-
-    if added > 0:
-        with open(site_data_path, "w") as f:
-            json.dump(site_data, f, indent=2, ensure_ascii=False)
-        logging.info(f"Merged {added} new cities into {site_data_path}")
+    if added or updated:
+        written = publisher.write()
+        logging.info(f"Published {added} new and {updated} updated cities "
+                     f"({written} files written to {publisher.dir})")
 
         # Update sitemap
-        update_sitemap(new_cities)
+        update_sitemap(cities)
     else:
-        logging.info("No new cities to merge")
+        logging.info("No site data changes to publish")
 
 
-def update_sitemap(new_cities: list[dict]):
-    """Rebuild the entire sitemap from city-data.json to ensure valid XML."""
-    sitemap_path = Path("./public/sitemap.xml")
-    site_data_path = Path("./src/lib/city-data.json")
+SITEMAP_MAX_URLS = 50_000          # Per-file limits from the sitemaps.org protocol
+SITEMAP_MAX_BYTES = 50 * 1024 * 1024
 
-    # Load all cities from site data
-    all_cities = []
-    if site_data_path.exists():
-        try:
-            with open(site_data_path) as f:
-                data = json.load(f)
-            if isinstance(data, dict) and "cities" in data:
-                all_cities = data["cities"]
-            elif isinstance(data, list):
-                all_cities = data
-        except Exception as e:
-            logging.error(f"Failed to read city-data.json for sitemap: {e}")
-            return
+SITEMAP_STATIC_PAGES = [
+    ("", "1.0"),
+    ("/cities", "0.9"),
+    ("/countries", "0.9"),
+    ("/regions", "0.9"),
+    ("/scams", "0.8"),
+    ("/about", "0.5"),
+]
 
-    today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+# Keys of TOPICS in src/app/topics/[slug]/page.tsx
+SITEMAP_TOPICS = ["scams", "neighborhoods", "solo-female", "customs", "night-safety",
+                  "transport", "health", "digital-safety"]
 
-    # Build sitemap XML
-    xml = '<?xml version="1.0" encoding="UTF-8"?>\n'
-    xml += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+def sitemap_entries(all_cities: list[dict]):
+    """Yield (path, lastmod, priority) for every page, reusing city lastUpdated dates.
 
-    # Static pages
-    static_pages = [
-        ("https://www.isitsafetovisit.com", "1.0"),
-        ("https://www.isitsafetovisit.com/cities", "0.9"),
-        ("https://www.isitsafetovisit.com/countries", "0.9"),
-        ("https://www.isitsafetovisit.com/regions", "0.9"),
-        ("https://www.isitsafetovisit.com/scams", "0.8"),
-        ("https://www.isitsafetovisit.com/about", "0.5"),
-    ]
-    for url, priority in static_pages:
-        xml += f'  <url><loc>{url}</loc><priority>{priority}</priority></url>\n'
+    Country and region pages get the newest lastUpdated of their cities, so
+    an unchanged corpus produces a byte-identical sitemap.
+    """
+    country_lastmod = {}
+    region_lastmod = {}
+    for city in all_cities:
+        lastmod = city.get("lastUpdated", "")
+        if city.get("country"):
+            key = country_slug(city["country"])
+            country_lastmod[key] = max(country_lastmod.get(key, ""), lastmod)
+        if city.get("regionSlug"):
+            key = region_slug(city["regionSlug"])
+            region_lastmod[key] = max(region_lastmod.get(key, ""), lastmod)
+
+    for path, priority in SITEMAP_STATIC_PAGES:
+        yield path, None, priority
 
     # City pages + country pages
-    country_slugs = set()
+    seen_countries = set()
     for city in all_cities:
         slug = city.get("slug", "")
         if not slug:
             continue
-        lastmod = city.get("lastUpdated", today)
-        xml += f'  <url><loc>https://www.isitsafetovisit.com/cities/{slug}</loc><lastmod>{lastmod}</lastmod><priority>0.8</priority></url>\n'
+        yield f"/cities/{quote(slug)}", city.get("lastUpdated"), "0.8"
 
         # Add country page
-        country = city.get("country", "")
-        if country:
-            country_slug = country.lower().replace(" ", "-")
-            country_slug = "".join(c for c in country_slug if c.isalnum() or c == "-")
-            if country_slug not in country_slugs:
-                country_slugs.add(country_slug)
-                xml += f'  <url><loc>https://www.isitsafetovisit.com/countries/{country_slug}</loc><priority>0.7</priority></url>\n'
+        key = country_slug(city.get("country", ""))
+        if key and key not in seen_countries:
+            seen_countries.add(key)
+            yield f"/countries/{quote(key)}", country_lastmod[key] or None, "0.7"
+
+    for key in sorted(region_lastmod):
+        yield f"/regions/{quote(key)}", region_lastmod[key] or None, "0.7"
+    for topic in SITEMAP_TOPICS:
+        yield f"/topics/{topic}", None, "0.6"
+
+
+def _commit_if_changed(tmp: Path, final: Path, digest: str) -> bool:
+    """Move tmp over final unless final already has the same content."""
+    if final.exists() and hashlib.sha256(final.read_bytes()).hexdigest() == digest:
+        tmp.unlink()
+        return False
+    tmp.replace(final)
+    return True
+
+
+@instrumented("sitemap.write", io=True)
+def update_sitemap(new_cities: list[dict] = None):
+    """Rebuild the sitemap from the published site data, streaming it to disk.
+
+    Splits into sitemap-N.xml files under a sitemap index past 50,000 URLs
+    or 50 MB, and leaves files untouched when their content is unchanged.
+    """
+    sitemap_path = CONFIG["sitemap_file"]
+    base = CONFIG["site_url"]
+    try:
+        all_cities = list(get_site_publisher().entries.values())
+    except Exception as e:
+        logging.error(f"Failed to read site data index for sitemap: {e}")
+        return
+
+    header = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n').encode()
+    footer = b'</urlset>\n'
+    sitemap_path.parent.mkdir(parents=True, exist_ok=True)
+
+    parts = []  # (tmp path, sha256 hex digest)
+    f = digest = None
+    count = size = total = 0
+
+    def close_part():
+        f.write(footer)
+        digest.update(footer)
+        f.close()
+        parts[-1] = (parts[-1][0], digest.hexdigest())
+
+    for path, lastmod, priority in sitemap_entries(all_cities):
+        lastmod_xml = f"<lastmod>{escape(lastmod)}</lastmod>" if lastmod else ""
+        line = f"  <url><loc>{escape(base + path)}</loc>{lastmod_xml}<priority>{priority}</priority></url>\n".encode()
+        if f is None or count >= SITEMAP_MAX_URLS or size + len(line) + len(footer) > SITEMAP_MAX_BYTES:
+            if f is not None:
+                close_part()
+            tmp = sitemap_path.with_name(f"{sitemap_path.stem}.part{len(parts) + 1}.tmp")
+            f = open(tmp, "wb")
+            digest = hashlib.sha256()
+            parts.append((tmp, None))
+            f.write(header)
+            digest.update(header)
+            count, size = 0, len(header)
+        f.write(line)
+        digest.update(line)
+        count += 1
+        size += len(line)
+        total += 1
+    close_part()
+
+    changed = 0
+    stale_parts = set(sitemap_path.parent.glob(f"{sitemap_path.stem}-*.xml"))
+    if len(parts) == 1:
+        changed += _commit_if_changed(parts[0][0], sitemap_path, parts[0][1])
+    else:
+        index = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+        for n, (tmp, part_digest) in enumerate(parts, start=1):
+            final = sitemap_path.with_name(f"{sitemap_path.stem}-{n}.xml")
+            stale_parts.discard(final)
+            changed += _commit_if_changed(tmp, final, part_digest)
+            index.append(f"  <sitemap><loc>{escape(f'{base}/{final.name}')}</loc></sitemap>")
+        index.append("</sitemapindex>\n")
+        index_bytes = "\n".join(index).encode()
+        tmp = sitemap_path.with_suffix(".xml.tmp")
+        tmp.write_bytes(index_bytes)
+        changed += _commit_if_changed(tmp, sitemap_path, hashlib.sha256(index_bytes).hexdigest())
+    for path in stale_parts:
+        path.unlink()
+        changed += 1
+
+    if changed:
+        logging.info(f"Rebuilt sitemap with {total} URLs in {len(parts)} file(s)")
+    else:
+        logging.info(f"Sitemap unchanged ({total} URLs)")
 
-    xml += '</urlset>\n'
 
-    with open(sitemap_path, "w") as f:
-        f.write(xml)
+RANK_FIELDS = ("global_rank", "overall_safety_score", "safety_tier", "trending")
 
-    total_urls = len(all_cities) + len(country_slugs) + len(static_pages)
-    logging.info(f"Rebuilt sitemap with {total_urls} URLs ({len(all_cities)} cities, {len(country_slugs)} countries, {len(static_pages)} static)")
 
+@instrumented("rank")
+def run_rankings(incremental: bool = True) -> dict:
+    """Recalculate all rankings.
 
-def run_rankings():
-    """Recalculate all rankings."""
+    In incremental mode only cities whose rank, score or tier moved are
+    saved, so a run where nothing changed writes no city files at all.
+    """
     cities = get_all_cities()
     if not cities:
         logging.info("No cities to rank")
-        return
+        return {"ranked": 0, "changed": 0, "rank_movements": 0}
 
+    previous = {city_key(c): tuple(c.get(f) for f in RANK_FIELDS) for c in cities}
     ranked = recalculate_rankings(cities)
-    logging.info(f"Ranked {len(ranked)} cities")
 
-    # Save updated cities with ranks
+    # Record this run, then derive trending from the windowed history
+    history = get_ranking_history()
+    history.append(ranked)
+    trends = history.trends()
     for city in ranked:
+        if city_key(city) in trends:
+            city["trending"] = trends[city_key(city)]
+
+    changed = []
+    rank_movements = 0
+    for city in ranked:
+        before = previous[city_key(city)]
+        if tuple(city.get(f) for f in RANK_FIELDS) != before:
+            changed.append(city)
+            if city.get("global_rank") != before[0]:
+                rank_movements += 1
+    logging.info(f"Ranked {len(ranked)} cities: {len(changed)} changed, {rank_movements} rank movements")
+
+    # Save updated cities with ranks
+    for city in changed if incremental else ranked:
         save_city(city)
+    flush_cities()
 
     # Save rankings summary
-    CONFIG["rankings_file"].parent.mkdir(parents=True, exist_ok=True)
     rankings_summary = [{
         "rank": c["global_rank"],
-        "city_id": c["city_id"],
-        "name": c["name"],
-        "country": c["country"],
-        "score": c["overall_safety_score"],
-        "tier": c["safety_tier"],
+        "city_id": city_key(c),
+        "name": c.get("name"),
+        "country": c.get("country"),
+        "score": c.get("overall_safety_score"),
+        "tier": c.get("safety_tier"),
         "trending": c.get("trending", "stable"),
     } for c in ranked]
+    summary_text = json.dumps(rankings_summary, indent=2)
+    rankings_file = CONFIG["rankings_file"]
+    if not rankings_file.exists() or rankings_file.read_text() != summary_text:
+        rankings_file.parent.mkdir(parents=True, exist_ok=True)
+        rankings_file.write_text(summary_text)
+
+    if changed or not incremental:
+        log_change("rankings", "all",
+                   f"Recalculated rankings for {len(ranked)} cities "
+                   f"({len(changed)} changed, {rank_movements} rank movements)")
+    return {"ranked": len(ranked), "changed": len(changed), "rank_movements": rank_movements}
+
+
+DISTRIBUTION_PERCENTILES = (0, 25, 50, 75, 100)
+
+
+NEIGHBOUR_CHUNK_ROWS = 1024  # Caps the distance block at 1024 x n floats
+
+
+def nearest_neighbours(X: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k rows closest to each row by Euclidean distance (self excluded).
+
+    Distances are computed NEIGHBOUR_CHUNK_ROWS rows at a time from
+    |a|^2 + |b|^2 - 2ab, so memory stays O(chunk x n) rather than O(n^2).
+    """
+    n = len(X)
+    k = min(k, n - 1)
+    if k <= 0:
+        return np.empty((n, 0), dtype=int)
+    X = np.asarray(X, dtype=float)
+    sq = (X * X).sum(axis=1)
+    result = np.empty((n, k), dtype=int)
+    for start in range(0, n, NEIGHBOUR_CHUNK_ROWS):
+        stop = min(start + NEIGHBOUR_CHUNK_ROWS, n)
+        d2 = sq[start:stop, None] + sq[None, :] - 2 * X[start:stop] @ X.T
+        d2[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        nearest = np.argpartition(d2, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(d2, nearest, axis=1).argsort(axis=1, kind="stable")
+        result[start:stop] = np.take_along_axis(nearest, order, axis=1)
+    return result
+
+
+def score_distribution(X: np.ndarray, overall: np.ndarray) -> dict:
+    """Per-category percentiles and mean, plus a 0-10 histogram of overall scores."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # All-NaN categories stay NaN
+        pct = np.nanpercentile(X, DISTRIBUTION_PERCENTILES, axis=0)
+        mean = np.nanmean(X, axis=0)
+    histogram, _ = np.histogram(overall[~np.isnan(overall)], bins=10, range=(0, 10))
+    return {
+        "scores": {
+            field: {
+                "min": round(float(pct[0, j]), 1), "p25": round(float(pct[1, j]), 1),
+                "median": round(float(pct[2, j]), 1), "p75": round(float(pct[3, j]), 1),
+                "max": round(float(pct[4, j]), 1), "mean": round(float(mean[j]), 1),
+            }
+            for j, field in enumerate(SCORE_FIELDS) if not np.isnan(mean[j])
+        },
+        "overallHistogram": histogram.tolist(),
+    }
 
-    with open(CONFIG["rankings_file"], "w") as f:
-        json.dump(rankings_summary, f, indent=2)
 
-    log_change("rankings", "all", f"Recalculated rankings for {len(ranked)} cities")
+@instrumented("site_aggregates")
+def run_site_aggregates() -> dict:
+    """Post-rank stage: related cities, region/country groupings and score distributions.
 
+    The related map starts from each city's relatedCities that exist in the
+    corpus and tops up with the nearest cities in the same region by their
+    seven category scores. It is written with the groupings and
+    distributions to site_aggregates_file for the site to read directly;
+    the model-authored relatedCities in the city files are left as they are.
+    """
+    cities = [c for c in get_all_cities() if c.get("slug")]
+    if not cities:
+        logging.info("No cities to aggregate")
+        return {"cities": 0, "invalid_related": 0}
+
+    X = score_matrix(cities)
+    # Fill gaps with the corpus mean so one missing category doesn't drop a city
+    col_mean = np.nan_to_num(np.nanmean(X, axis=0), nan=5.0)
+    filled = np.where(np.isnan(X), col_mean, X)
+    overall = np.array([c.get("overallScore") if isinstance(c.get("overallScore"), (int, float))
+                        else np.nan for c in cities], dtype=float)
+    slugs = [c["slug"] for c in cities]
+    known = set(slugs)
+
+    regions = defaultdict(list)
+    countries = defaultdict(list)
+    for i, city in enumerate(cities):
+        regions[region_slug(city.get("regionSlug", ""))].append(i)
+        countries[country_slug(city.get("country", ""))].append(i)
+
+    k = CONFIG["related_cities_count"]
+    related = {}
+    invalid = 0
+    for members in regions.values():
+        idx = np.array(members)
+        neighbours = idx[nearest_neighbours(filled[idx], k)]
+        for row, i in enumerate(members):
+            city = cities[i]
+            current = city.get("relatedCities") or []
+            keep = []
+            for slug in current:
+                if slug in known and slug != city["slug"] and slug not in keep:
+                    keep.append(slug)
+            invalid += sum(1 for slug in current if slug not in known)
+            for j in neighbours[row]:
+                if len(keep) >= k:
+                    break
+                if slugs[j] not in keep:
+                    keep.append(slugs[j])
+            related[city["slug"]] = keep
+
+    def group(members: list[int], name: str) -> dict:
+        idx = np.array(members)
+        safest_first = idx[np.argsort(-np.nan_to_num(overall[idx]), kind="stable")]
+        return {
+            "name": name,
+            "cityCount": len(members),
+            "cities": [slugs[i] for i in safest_first],
+            **score_distribution(X[idx], overall[idx]),
+        }
+
+    aggregates = {
+        "regions": {slug: group(m, cities[m[0]].get("region", slug))
+                    for slug, m in sorted(regions.items()) if slug},
+        "countries": {slug: {**group(m, cities[m[0]].get("country", slug)),
+                             "regionSlug": region_slug(cities[m[0]].get("regionSlug", ""))}
+                      for slug, m in sorted(countries.items()) if slug},
+        "related": related,
+    }
+    if _write_json_if_changed(CONFIG["site_aggregates_file"], aggregates):
+        logging.info(f"Wrote site aggregates to {CONFIG['site_aggregates_file']}")
+    logging.info(f"Aggregated {len(cities)} cities into {len(aggregates['regions'])} regions and "
+                 f"{len(aggregates['countries'])} countries; {invalid} unknown relatedCities slugs "
+                 f"left out of the related map")
+    return {"cities": len(cities), "invalid_related": invalid}
 
+
+@instrumented("alerts")
 def run_alerts(client):
     """Check for breaking safety events."""
     cities = get_all_cities()
@@ -943,6 +3589,7 @@ def run_alerts(client):
 
     alerts = check_alerts(client, cities)
     if alerts:
+        refreshed = []
         logging.warning(f"ALERTS DETECTED: {len(alerts)}")
         for alert in alerts:
             logging.warning(f"  [{alert.get('severity', '?')}] {alert.get('city_id', '?')}: {alert.get('summary', '?')}")
@@ -950,15 +3597,21 @@ def run_alerts(client):
 
             # Auto-refresh cities with critical alerts
             if alert.get("severity") == "critical":
-                city = load_city(alert["city_id"])
+                city = load_city(alert.get("city_id", ""))
                 if city:
                     updated = refresh_city(client, city)
                     if updated:
                         save_city(updated)
+                        flush_cities()
+                        refreshed.append(updated)
+        flush_cities()
+        if refreshed:
+            merge_into_site_data(refreshed)
     else:
         logging.info("No safety alerts detected")
 
 
+@instrumented("single_city")
 def run_single_city(client, city_input: str):
     """Process a single city (add or refresh)."""
     parts = [p.strip() for p in city_input.split(",")]
@@ -967,14 +3620,15 @@ def run_single_city(client, city_input: str):
         return
 
     city_name, country = parts
-    city_id = f"{city_name.lower().replace(' ', '-')}-{country.lower().replace(' ', '-')}"
+    city_id = make_city_id(city_name, country)
 
     existing = load_city(city_id)
+    city_data = None
     if existing:
         logging.info(f"City exists, refreshing: {city_name}")
-        updated = refresh_city(client, existing)
-        if updated:
-            save_city(updated)
+        city_data = refresh_city(client, existing)
+        if city_data:
+            save_city(city_data)
             log_change("refresh", city_id, "Manual single-city refresh")
     else:
         logging.info(f"New city, generating: {city_name}")
@@ -982,6 +3636,52 @@ def run_single_city(client, city_input: str):
         if city_data:
             save_city(city_data)
             log_change("add", city_id, "Manual single-city addition")
+    flush_cities()
+    if city_data:
+        merge_into_site_data([city_data])
+
+
+@instrumented("sanitize")
+def run_sanitize():
+    """Re-sanitize every stored city; only records that change are rewritten."""
+    cities = get_all_cities()
+    for city in cities:
+        sanitize_city_data(city, city.get("name", ""), city.get("country", ""), fetch_image=False)
+        save_city(city)
+    written = flush_cities()
+    logging.info(f"Sanitized {len(cities)} cities, {written} changed")
+    if written:
+        log_change("sanitize", "all", f"Re-sanitized {len(cities)} cities, {written} changed")
+
+
+@instrumented("image_backfill")
+def run_image_backfill():
+    """Fill imageUrl for every stored city missing one, in batched parallel lookups."""
+    missing = [c for c in get_all_cities() if not c.get("imageUrl") and c.get("name")]
+    if not missing:
+        logging.info("Every city already has an image")
+        return
+
+    resolver = get_image_resolver()
+    titles = []
+    for city in missing:
+        titles += [f"{city['name']}, {city.get('country', '')}", city["name"]]
+    chunks = [titles[i:i + resolver.MAX_TITLES] for i in range(0, len(titles), resolver.MAX_TITLES)]
+    found = {}
+    for _, images in run_concurrently(resolver.lookup, chunks, "images"):
+        found.update(images or {})
+
+    filled = 0
+    for city in missing:
+        img = found.get(f"{city['name']}, {city.get('country', '')}") or found.get(city["name"])
+        if img:
+            city["imageUrl"] = img
+            save_city(city)
+            filled += 1
+    flush_cities()
+    logging.info(f"Backfilled images for {filled}/{len(missing)} cities")
+    if filled:
+        log_change("images", "all", f"Backfilled images for {filled} cities")
 
 
 # ---------------------------------------------------------------------------
@@ -1111,10 +3811,34 @@ def generate_seed_queue():
 
 def main():
     parser = argparse.ArgumentParser(description="IsItSafeToVisit.com City Safety Agent")
-    parser.add_argument("--mode", choices=["full", "refresh", "add", "rank", "alert", "single", "seed"],
+    parser.add_argument("--mode", choices=["full", "refresh", "add", "rank", "alert", "single", "seed",
+                                           "batch-submit", "batch-collect", "sanitize", "images",
+                                           "merge-shards", "export-changelog"],
                         default="full", help="Pipeline mode")
     parser.add_argument("--city", type=str, help="City for single mode (format: 'City, Country')")
+    parser.add_argument("--full-rank", action="store_true",
+                        help="Rewrite every ranked city file instead of only those whose rank changed")
+    parser.add_argument("--cache", choices=["readwrite", "off", "replay"],
+                        help=f"Claude response cache mode (default: {CONFIG['cache_mode']})")
+    parser.add_argument("--workers", type=int, help=f"Concurrent Claude calls (default: {CONFIG['max_workers']})")
+    parser.add_argument("--fake-api", action="store_true",
+                        help="Use the offline fake Claude backend (fake_anthropic.py); implies --cache off "
+                             "and no Wikipedia lookups")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="Only take queue/stale cities whose id hashes to shard i of N (add/refresh)")
     args = parser.parse_args()
+    if args.shard and args.mode not in ("add", "refresh"):
+        parser.error("--shard only applies to add and refresh")
+
+    if args.workers:
+        CONFIG["max_workers"] = args.workers
+    if args.fake_api:
+        # Keep fake answers out of the real response cache unless asked for
+        CONFIG["client_backend"] = "fake"
+        CONFIG["cache_mode"] = "off"
+        CONFIG["fetch_images"] = False
+    if args.cache:
+        CONFIG["cache_mode"] = args.cache
 
     setup_logging()
     logging.info(f"Agent starting — mode: {args.mode}")
@@ -1122,9 +3846,39 @@ def main():
     if args.mode == "seed":
         generate_seed_queue()
         return
+    if args.mode == "export-changelog":
+        export_changelog()
+        return
+    if args.shard:
+        configure_shard(*args.shard)
+    if args.mode in ("sanitize", "images", "merge-shards"):
+        try:
+            if args.mode == "sanitize":
+                run_sanitize()
+            elif args.mode == "images":
+                run_image_backfill()
+            else:
+                run_merge_shards()
+        finally:
+            write_run_report(args.mode)
+        return
 
     client = get_client()
 
+    try:
+        run_mode(client, args)
+    finally:
+        flush_cities()
+        if args.shard:
+            write_shard_output()
+        log_rate_limit_metrics()
+        if CONFIG["client_backend"] == "fake":
+            logging.info(f"Fake API injected: {client.stats}")
+        write_run_report(args.mode)
+
+
+def run_mode(client, args):
+    """Dispatch a parsed --mode to its pipeline function."""
     match args.mode:
         case "full":
             run_full_pipeline(client)
@@ -1133,9 +3887,14 @@ def main():
         case "add":
             run_add_cities(client)
         case "rank":
-            run_rankings()
+            run_rankings(incremental=not args.full_rank)
+            run_site_aggregates()
         case "alert":
             run_alerts(client)
+        case "batch-submit":
+            run_batch_submit(client)
+        case "batch-collect":
+            run_batch_collect(client)
         case "single":
             if not args.city:
                 logging.error("--city required for single mode")
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the agent's corpus-scale helpers
+=======================================================
+
+Generates synthetic city corpora shaped like data/cities (real records are
+used as templates, with names, ids, scores and dates varied), then times the
+helpers whose cost grows with the corpus. No API or network calls are made.
+
+Usage:
+  python bench.py                          # 1k and 10k corpora, print results
+  python bench.py --sizes 1000,10000,100000
+  python bench.py --record                 # Save results as bench_baseline.json
+  python bench.py --check                  # Exit 1 if anything is >1.5x its baseline
+  python bench.py --check --tolerance 2.0
+
+Corpora are cached under --workdir (default: <tmp>/agent-bench) and reused
+between runs with the same size and seed. Baselines are machine-specific:
+record them on the machine (or CI runner type) that runs --check.
+"""
+
+import argparse
+import copy
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import agent
+
+REPO_DIR = Path(__file__).resolve().parent
+BASELINE_FILE = REPO_DIR / "bench_baseline.json"
+SCORE_FIELDS = agent.SCORE_FIELDS
+
+
+# ---------------------------------------------------------------------------
+# Synthetic corpus
+# ---------------------------------------------------------------------------
+
+def load_templates() -> list[dict]:
+    """Real city records to derive synthetic ones from."""
+    templates = []
+    for path in sorted((REPO_DIR / "data" / "cities").glob("*.json")):
+        with open(path, encoding="utf-8") as f:
+            city = json.load(f)
+        if isinstance(city.get("scores"), dict) and city.get("slug"):
+            templates.append(city)
+    if not templates:
+        sys.exit("No templates in data/cities — the generator needs at least one real record")
+    return templates
+
+
+def synthetic_city(i: int, template: dict, rng: random.Random) -> dict:
+    """One record with the template's shape and a unique id, slug and scores."""
+    city = copy.deepcopy(template)
+    name = f"{template['name']} {i}"
+    country = template.get("country", "Testland")
+    city_id = agent.make_city_id(name, country)
+    city["name"] = name
+    city["slug"] = city_id
+    city["_city_id"] = city_id
+    city.pop("city_id", None)
+    for field in SCORE_FIELDS:
+        city["scores"][field] = round(rng.uniform(1, 10), 1)
+    city["overallScore"] = round(sum(city["scores"][f] for f in SCORE_FIELDS) / len(SCORE_FIELDS), 1)
+    updated = datetime(2026, 1, 1, tzinfo=timezone.utc) + timedelta(days=rng.randrange(0, 280))
+    city["lastUpdated"] = updated.strftime("%Y-%m-%d")
+    city["relatedCities"] = [f"{template['slug']}-{rng.randrange(0, 10**6)}"
+                             for _ in range(len(template.get("relatedCities", [])))]
+    return city
+
+
+def build_corpus(workdir: Path, size: int, seed: int) -> Path:
+    """Write (or reuse) a corpus of size records; return its root directory."""
+    root = workdir / f"corpus-{size}-{seed}"
+    marker = root / ".complete"
+    if marker.exists():
+        return root
+    shutil.rmtree(root, ignore_errors=True)
+    cities_dir = root / "data" / "cities"
+    cities_dir.mkdir(parents=True)
+    templates = load_templates()
+    rng = random.Random(seed)
+    for i in range(size):
+        city = synthetic_city(i, templates[i % len(templates)], rng)
+        with open(cities_dir / f"{city['_city_id']}.json", "w", encoding="utf-8") as f:
+            f.write(agent._serialize_city(city))
+    marker.touch()
+    return root
+
+
+def response_text(city: dict) -> str:
+    """A generate-style response: prose around a fenced JSON record."""
+    body = json.dumps({k: v for k, v in city.items() if not k.startswith("_")}, indent=2,
+                      ensure_ascii=False)
+    return f"Here is the safety profile I researched.\n\n```json\n{body}\n```\n\nSources: advisories."
+
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+def reset_state():
+    """Drop every process-wide singleton so the next call starts cold."""
+    if agent._changelog is not None:
+        agent._changelog.close()
+    agent._changelog = None
+    agent._store = None
+    agent._staleness_index = None
+    agent._site_publisher = None
+
+
+def timed(func, repeat: int, setup=None) -> float:
+    """Best wall time of func() over repeat runs; setup() runs untimed before each."""
+    best = float("inf")
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_corpus(cities: list[dict], repeat: int) -> dict[str, float]:
+    """Time the helpers that walk the loaded corpus (or a 1000-city sample of it)."""
+    results = {}
+    results["recalculate_rankings"] = timed(lambda: agent.recalculate_rankings(cities), repeat)
+
+    sample = cities[: min(len(cities), 1000)]
+    texts = [response_text(c) for c in sample]
+    results["extract_json_x1000"] = timed(
+        lambda: [agent.extract_json(t, expect=dict) for t in texts], repeat)
+
+    def sanitize_all() -> float:
+        """Sanitize a copy of every city; copies are made (untimed) 1000 at a
+        time so a 100k corpus doesn't need a second full copy in memory.
+        """
+        elapsed = 0.0
+        for i in range(0, len(cities), 1000):
+            chunk = [copy.deepcopy(c) for c in cities[i:i + 1000]]
+            start = time.perf_counter()
+            for c in chunk:
+                agent.sanitize_city_data(c, c["name"], c.get("country", ""), fetch_image=False)
+            elapsed += time.perf_counter() - start
+        return elapsed
+
+    results["sanitize_city_data"] = min(sanitize_all() for _ in range(repeat))
+
+    def log_changes():
+        for city in sample:
+            agent.log_change("bench", agent.city_key(city), "synthetic change")
+        agent.get_changelog().close()
+
+    results["log_change_x1000"] = timed(log_changes, repeat)
+    return results
+
+
+def bench_site(root: Path, first: list[dict], repeat: int) -> dict[str, float]:
+    """Time a typical 50-city refresh publish and the sitemap rebuild."""
+    results = {}
+    changed = []
+
+    def touch_fifty():
+        agent._site_publisher = None
+        changed[:] = [dict(c, lastUpdated="2026-10-01", overallScore=round(random.uniform(1, 10), 1))
+                      for c in first]
+
+    results["merge_into_site_data_50"] = timed(lambda: agent.merge_into_site_data(changed), repeat,
+                                               setup=touch_fifty)
+
+    def stale_sitemap():
+        for path in (root / "public").glob("sitemap*.xml"):
+            path.unlink()
+
+    results["update_sitemap"] = timed(agent.update_sitemap, repeat, setup=stale_sitemap)
+    return results
+
+
+def run_benchmarks(root: Path, size: int, repeat: int) -> dict[str, float]:
+    """Time each helper against the corpus at root (the working directory)."""
+    os.chdir(root)
+    for stale in ("logs", "public", "src", "data/.staleness-index.json"):
+        path = root / stale
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+    reset_state()
+    results = {}
+
+    results["get_all_cities"] = timed(agent.get_all_cities, repeat, setup=reset_state)
+
+    def cold_stale():
+        agent._staleness_index = None
+        agent.CONFIG["staleness_index_file"].unlink(missing_ok=True)
+
+    results["get_stale_cities_cold"] = timed(lambda: agent.get_stale_cities(limit=50), repeat,
+                                             setup=cold_stale)
+    results["get_stale_cities_warm"] = timed(lambda: agent.get_stale_cities(limit=50), repeat)
+
+    cities = agent.get_all_cities()
+    results.update(bench_corpus(cities, repeat))
+
+    # Publish the whole corpus once, then time a typical refresh. A refresh run
+    # never holds the whole store, so drop it before the publisher reloads its
+    # shard index; at 100k two full copies don't fit in a small runner.
+    agent.merge_into_site_data(cities)
+    first = cities[:50]
+    del cities
+    reset_state()
+    gc.collect()
+    results.update(bench_site(root, first, repeat))
+    reset_state()
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Baselines
+# ---------------------------------------------------------------------------
+
+def load_baseline() -> dict:
+    if BASELINE_FILE.exists():
+        with open(BASELINE_FILE) as f:
+            return json.load(f)
+    return {}
+
+
+def record_baseline(results: dict[int, dict[str, float]]):
+    baseline = load_baseline()
+    baseline["meta"] = {
+        "recorded": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+    baseline.setdefault("results", {})
+    for size, timings in results.items():
+        baseline["results"][str(size)] = {k: round(v, 6) for k, v in timings.items()}
+    with open(BASELINE_FILE, "w") as f:
+        json.dump(baseline, f, indent=2)
+        f.write("\n")
+    print(f"Recorded baseline for sizes {sorted(results)} in {BASELINE_FILE.name}")
+
+
+def check_baseline(results: dict[int, dict[str, float]], tolerance: float) -> list[str]:
+    """Benchmarks slower than tolerance x their recorded baseline."""
+    recorded = load_baseline().get("results", {})
+    regressions = []
+    for size, timings in results.items():
+        for name, seconds in timings.items():
+            base = recorded.get(str(size), {}).get(name)
+            # Sub-millisecond timings are mostly noise; give them a floor
+            if base is not None and seconds > max(base, 0.001) * tolerance:
+                regressions.append(f"{name} @ {size}: {seconds:.4f}s vs baseline {base:.4f}s "
+                                   f"({seconds / base:.1f}x)")
+    return regressions
+
+
+def print_table(results: dict[int, dict[str, float]]):
+    recorded = load_baseline().get("results", {})
+    print(f"{'benchmark':<28}{'size':>8}{'seconds':>12}{'baseline':>12}{'ratio':>8}")
+    for size, timings in results.items():
+        for name, seconds in timings.items():
+            base = recorded.get(str(size), {}).get(name)
+            base_text = f"{base:.4f}" if base is not None else "-"
+            ratio = f"{seconds / base:.2f}" if base else "-"
+            print(f"{name:<28}{size:>8}{seconds:>12.4f}{base_text:>12}{ratio:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for agent.py")
+    parser.add_argument("--sizes", default="1000,10000", help="Comma-separated corpus sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark (best is kept)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", type=Path, default=Path(tempfile.gettempdir()) / "agent-bench")
+    parser.add_argument("--record", action="store_true", help="Save results as the baseline")
+    parser.add_argument("--check", action="store_true", help="Fail on regressions against the baseline")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="Slowdown factor that counts as a regression (default: 1.5)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(message)s")
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    args.workdir.mkdir(parents=True, exist_ok=True)
+
+    results = {}
+    cwd = os.getcwd()
+    try:
+        for size in sizes:
+            root = build_corpus(args.workdir.resolve(), size, args.seed)
+            results[size] = run_benchmarks(root, size, args.repeat)
+    finally:
+        os.chdir(cwd)
+
+    print_table(results)
+    if args.record:
+        record_baseline(results)
+    if args.check:
+        regressions = check_baseline(results, args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nNo regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+// build-city-data.js
+// Assembles src/lib/city-data.json (imported by src/lib/cities.ts) from the
+// per-city shards agent.py publishes under src/lib/site-data/, plus the
+// redirects for slugs a city has moved away from and the related-cities map
+// from aggregates.json
+// Run: node build-city-data.js  (runs automatically before `next build` and `next dev`)
+// Leaves an existing city-data.json alone if the shards have not been published yet
+
+const fs = require('fs');
+
+const SHARD_DIR = 'src/lib/site-data';
+const OUTPUT = 'src/lib/city-data.json';
+
+if (!fs.existsSync(`${SHARD_DIR}/index.json`)) {
+  console.log(`No ${SHARD_DIR}/index.json — keeping ${OUTPUT} as is`);
+  process.exit(0);
+}
+
+const index = JSON.parse(fs.readFileSync(`${SHARD_DIR}/index.json`, 'utf-8'));
+const cities = index.cities.map(card =>
+  JSON.parse(fs.readFileSync(`${SHARD_DIR}/cities/${card.slug}.json`, 'utf-8')));
+
+const readOptional = (name, fallback) => fs.existsSync(`${SHARD_DIR}/${name}`)
+  ? JSON.parse(fs.readFileSync(`${SHARD_DIR}/${name}`, 'utf-8'))
+  : fallback;
+const redirects = readOptional('redirects.json', {});
+const related = readOptional('aggregates.json', {}).related || {};
+
+fs.writeFileSync(OUTPUT, JSON.stringify({ metadata: index.metadata, cities, redirects, related }));
+console.log(`Wrote ${cities.length} cities to ${OUTPUT}`);
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Anthropic client
+=======================================
+
+FakeAnthropic implements the slice of the SDK the agent uses:
+- messages.create
+- messages.stream
+- messages.with_raw_response.create
+- messages.batches.create / retrieve / results
+
+It answers from the records in data/cities instead of the network:
+- generate prompts get the stored record (or a renamed copy of a similar one)
+- refresh prompts get a small score patch
+- alert prompts get an empty or synthetic alert list
+Latency, 429/529 errors, max_tokens truncation and malformed JSON are
+injected at configurable rates, so the concurrency, retry, continuation and
+parse paths can be load-tested offline.
+
+Usage (via agent.py):
+  python agent.py --mode full --fake-api      # Whole pipeline against the fake
+  CONFIG["fake_api"] in agent.py sets latency and fault rates.
+
+Run it on a scratch copy of the repo: the pipeline still writes city files,
+site data and the changelog as usual.
+"""
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+_GENERATE = re.compile(r"complete safety profile for (.+), (.+?)\.\n")
+_REFRESH = re.compile(r"Current safety summary for (.+?), (.+?):\n(\{.*\})\n")
+_ALERT_ID = re.compile(r"\[([^\[\]\s]+)\]")
+
+
+class FakeAPIError(Exception):
+    """Shaped like anthropic.APIStatusError: status_code plus response.headers."""
+
+    def __init__(self, status_code: int, message: str, retry_after: float = None):
+        super().__init__(f"Error code: {status_code} - {message}")
+        self.status_code = status_code
+        headers = {"retry-after": f"{retry_after:g}"} if retry_after is not None else {}
+        self.response = SimpleNamespace(status_code=status_code, headers=headers)
+
+
+def _message(text: str, stop_reason: str, input_tokens: int, searches: int, model: str):
+    content = []
+    if searches:
+        content.append(SimpleNamespace(type="server_tool_use", name="web_search"))
+        content.append(SimpleNamespace(type="web_search_tool_result"))
+    content.append(SimpleNamespace(type="text", text=text))
+    usage = SimpleNamespace(
+        input_tokens=input_tokens,
+        output_tokens=max(1, len(text) // 4),
+        server_tool_use=SimpleNamespace(web_search_requests=searches),
+    )
+    return SimpleNamespace(id=f"msg_fake_{hashlib.sha1(text.encode()).hexdigest()[:12]}",
+                           type="message", role="assistant", model=model, content=content,
+                           stop_reason=stop_reason, usage=usage)
+
+
+class FakeBackend:
+    """Canned answers plus fault injection, shared by all fake endpoints."""
+
+    def __init__(self, data_dir: Path, latency: float = 0.5, jitter: float = 0.5,
+                 tokens_per_second: float = 400, rate_429: float = 0.0, rate_529: float = 0.0,
+                 truncate_rate: float = 0.0, malformed_rate: float = 0.0, alert_rate: float = 0.0,
+                 seed: int = None):
+        self.data_dir = Path(data_dir)
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.rate_429 = rate_429
+        self.rate_529 = rate_529
+        self.truncate_rate = truncate_rate
+        self.malformed_rate = malformed_rate
+        self.alert_rate = alert_rate
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.stats = {"calls": 0, "errors_429": 0, "errors_529": 0, "truncated": 0,
+                      "malformed": 0, "continuations": 0}
+        self._lock = threading.Lock()
+        self._templates = None
+
+    # -- canned answers ----------------------------------------------------
+
+    def _prompt_rng(self, prompt: str) -> random.Random:
+        """Deterministic per prompt, so a continuation sees the same full answer."""
+        digest = hashlib.sha256(f"{self.seed}:{prompt}".encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def templates(self) -> list[dict]:
+        with self._lock:
+            if self._templates is None:
+                self._templates = []
+                for path in sorted(self.data_dir.glob("*.json")):
+                    try:
+                        with open(path, encoding="utf-8") as f:
+                            self._templates.append(json.load(f))
+                    except (OSError, json.JSONDecodeError):
+                        continue
+        return self._templates
+
+    def _generated_city(self, name: str, country: str, rng: random.Random) -> dict:
+        # Same id formula as agent.make_city_id
+        path = self.data_dir / f"{name.lower().replace(' ', '-')}-{country.lower().replace(' ', '-')}.json"
+        if path.exists():
+            with open(path, encoding="utf-8") as f:
+                city = json.load(f)
+        else:
+            templates = self.templates()
+            same_country = [t for t in templates if t.get("country") == country]
+            city = json.loads(json.dumps(rng.choice(same_country or templates or [{}])))
+            city.update(name=name, country=country, slug=name.lower().replace(" ", "-"))
+        return {k: v for k, v in city.items() if not k.startswith("_")}
+
+    def answer(self, user_prompt: str) -> str:
+        """The complete answer text the fake would give to this prompt."""
+        rng = self._prompt_rng(user_prompt)
+        if match := _GENERATE.search(user_prompt):
+            city = self._generated_city(match.group(1), match.group(2), rng)
+            return f"```json\n{json.dumps(city, indent=2, ensure_ascii=False)}\n```"
+        if match := _REFRESH.search(user_prompt):
+            try:
+                view = json.loads(match.group(3))
+            except json.JSONDecodeError:
+                view = {}
+            scores = view.get("scores") if isinstance(view.get("scores"), dict) else {}
+            patch = {"scores": {k: round(min(10, max(1, v + rng.choice((-0.3, -0.1, 0.1, 0.3)))), 1)
+                                for k, v in scores.items() if isinstance(v, (int, float))},
+                     "revisionNotes": "Synthetic refresh from the fake backend"}
+            return json.dumps(patch, ensure_ascii=False)
+        if "breaking safety events" in user_prompt:
+            alerts = [{"city_id": city_id, "alert_type": "advisory_change", "severity": "low",
+                       "summary": "Synthetic alert from the fake backend", "action": "add_incident"}
+                      for city_id in _ALERT_ID.findall(user_prompt) if rng.random() < self.alert_rate]
+            return json.dumps(alerts)
+        return "{}"
+
+    # -- requests ----------------------------------------------------------
+
+    def respond(self, params: dict):
+        """(final message, seconds of latency to simulate, headers) for one call.
+
+        Raises FakeAPIError for injected 429/529s; the caller does the sleeping.
+        """
+        with self._lock:
+            self.stats["calls"] += 1
+            roll = self.rng.random()
+            cut = self.rng.uniform(0.3, 0.9)
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            corrupt = self.rng.random() < self.malformed_rate
+            truncate = self.rng.random() < self.truncate_rate
+        if roll < self.rate_429:
+            self._count("errors_429")
+            time.sleep(min(delay, 0.05))
+            raise FakeAPIError(429, "rate_limit_error: fake backend", retry_after=1)
+        if roll < self.rate_429 + self.rate_529:
+            self._count("errors_529")
+            time.sleep(min(delay, 0.05))
+            raise FakeAPIError(529, "overloaded_error: fake backend")
+
+        messages = params["messages"]
+        user_prompt = messages[0]["content"]
+        text = self.answer(user_prompt)
+        if messages[-1]["role"] == "assistant":
+            # Continuation of a truncated answer: send the rest
+            self._count("continuations")
+            prefix = messages[-1]["content"]
+            text = text[len(prefix):] if text.startswith(prefix) else text
+            truncate = corrupt = False
+        if corrupt:
+            self._count("malformed")
+            text = text.replace(":", "", 1).replace("}", "", 1)
+        stop_reason = "end_turn"
+        if truncate and len(text) > 20:
+            self._count("truncated")
+            text = text[: int(len(text) * cut)]
+            stop_reason = "max_tokens"
+
+        if self.tokens_per_second:
+            delay += (len(text) / 4) / self.tokens_per_second
+        input_tokens = (len(params.get("system", "")) + sum(len(m["content"]) for m in messages)) // 4
+        searches = self._prompt_rng(user_prompt).randint(1, 5) if params.get("tools") else 0
+        message = _message(text, stop_reason, input_tokens, searches, params.get("model", "fake"))
+        return message, delay, {"request-id": message.id}
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+
+class FakeStream:
+    """Context manager mirroring MessageStream: iterate events, then get_final_message()."""
+
+    CHUNKS = 8
+
+    def __init__(self, backend: FakeBackend, params: dict):
+        self.backend = backend
+        self.params = params
+
+    def __enter__(self):
+        self.message, self.delay, headers = self.backend.respond(self.params)
+        self.response = SimpleNamespace(headers=headers)
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        text = self.message.content[-1].text
+        step = max(1, -(-len(text) // self.CHUNKS))
+        time.sleep(self.delay / 2)  # Time to first token
+        yield SimpleNamespace(type="message_start", message=self.message)
+        for start in range(0, len(text), step):
+            time.sleep(self.delay / 2 / self.CHUNKS)
+            yield SimpleNamespace(type="content_block_delta",
+                                  delta=SimpleNamespace(type="text_delta", text=text[start:start + step]))
+        yield SimpleNamespace(type="message_delta",
+                              delta=SimpleNamespace(stop_reason=self.message.stop_reason),
+                              usage=self.message.usage)
+        yield SimpleNamespace(type="message_stop")
+
+    def get_final_message(self):
+        return self.message
+
+
+class FakeRawResponse:
+    def __init__(self, message, headers: dict):
+        self._message = message
+        self.headers = headers
+
+    def parse(self):
+        return self._message
+
+
+class FakeRawMessages:
+    def __init__(self, backend: FakeBackend):
+        self._backend = backend
+
+    def create(self, **params):
+        message, delay, headers = self._backend.respond(params)
+        time.sleep(delay)
+        return FakeRawResponse(message, headers)
+
+
+class FakeBatches:
+    """Message Batches that finish `delay` seconds after submission.
+
+    Batches are kept in a JSON state file so batch-submit and batch-collect
+    can run as separate processes; injected errors become errored results.
+    """
+
+    def __init__(self, backend: FakeBackend, state_file: Path, delay: float = 0.0):
+        self._backend = backend
+        self._state_file = Path(state_file)
+        self._delay = delay
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        if self._state_file.exists():
+            with open(self._state_file) as f:
+                return json.load(f)
+        return {}
+
+    def create(self, requests: list[dict]):
+        results = []
+        for request in requests:
+            try:
+                message, _, _ = self._backend.respond(request["params"])
+                results.append({"custom_id": request["custom_id"], "type": "succeeded",
+                                "text": message.content[-1].text, "stop_reason": message.stop_reason,
+                                "input_tokens": message.usage.input_tokens})
+            except FakeAPIError as e:
+                results.append({"custom_id": request["custom_id"], "type": "errored", "error": str(e)})
+        with self._lock:
+            batches = self._load()
+            batch_id = f"msgbatch_fake_{len(batches):04d}"
+            batches[batch_id] = {"created": time.time(), "results": results}
+            self._state_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(self._state_file, "w") as f:
+                json.dump(batches, f)
+        return self.retrieve(batch_id)
+
+    def retrieve(self, batch_id: str):
+        batch = self._load().get(batch_id)
+        if batch is None:
+            raise FakeAPIError(404, f"not_found_error: {batch_id}")
+        ended = time.time() - batch["created"] >= self._delay
+        return SimpleNamespace(id=batch_id, processing_status="ended" if ended else "in_progress")
+
+    def results(self, batch_id: str):
+        for item in self._load()[batch_id]["results"]:
+            if item["type"] == "succeeded":
+                message = _message(item["text"], item["stop_reason"], item["input_tokens"], 0, "fake")
+                result = SimpleNamespace(type="succeeded", message=message)
+            else:
+                result = SimpleNamespace(type="errored", error=item["error"])
+            yield SimpleNamespace(custom_id=item["custom_id"], result=result)
+
+
+class FakeMessages:
+    def __init__(self, backend: FakeBackend, batch_state_file: Path, batch_delay: float):
+        self._backend = backend
+        self.with_raw_response = FakeRawMessages(backend)
+        self.batches = FakeBatches(backend, batch_state_file, batch_delay)
+
+    def create(self, **params):
+        message, delay, _ = self._backend.respond(params)
+        time.sleep(delay)
+        return message
+
+    def stream(self, **params):
+        return FakeStream(self._backend, params)
+
+
+class FakeAnthropic:
+    """Drop-in for anthropic.Anthropic(); see FakeBackend for the knobs."""
+
+    def __init__(self, data_dir: Path, batch_state_file: Path = None, batch_delay: float = 0.0,
+                 **backend_options):
+        self.backend = FakeBackend(data_dir, **backend_options)
+        state_file = batch_state_file or Path(data_dir).parent / ".cache" / "fake_batches.json"
+        self.messages = FakeMessages(self.backend, state_file, batch_delay)
+
+    @property
+    def stats(self) -> dict:
+        return dict(self.backend.stats)
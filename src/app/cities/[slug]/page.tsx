@@ -1,11 +1,12 @@
 import { Metadata } from 'next';
 import Link from 'next/link';
+import { redirect } from 'next/navigation';
 import Footer from '@/components/Footer';
 import ScoreRow from '@/components/ScoreRow';
-import { getAllSlugs, getCityBySlug, getRelatedCities, formatDate, getScoreColor, type City } from '@/lib/cities';
+import { getAllSlugs, getRedirectSlugs, getRedirect, getCityBySlug, getRelatedCities, formatDate, getScoreColor, type City } from '@/lib/cities';
 
 export function generateStaticParams() {
-  return getAllSlugs().map(slug => ({ slug }));
+  return [...getAllSlugs(), ...getRedirectSlugs()].map(slug => ({ slug }));
 }
 
 export function generateMetadata({ params }: { params: { slug: string } }): Metadata {
@@ -24,7 +25,11 @@ function getBookingUrl(cityName: string, countryName: string): string {
 
 export default function CityPage({ params }: { params: { slug: string } }) {
   const city = getCityBySlug(params.slug);
-  if (!city) return <div>City not found</div>;
+  if (!city) {
+    const target = getRedirect(params.slug);
+    if (target) redirect(`/cities/${target}`);
+    return <div>City not found</div>;
+  }
 
   const related = getRelatedCities(city);
   const bookingUrl = getBookingUrl(city.name, city.country);
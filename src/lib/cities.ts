@@ -55,7 +55,14 @@ export interface City {
   imageUrl?: string;
 }
 
-const data = cityData as { metadata: any; cities: City[] };
+// redirects maps slugs a city has moved away from to its current slug;
+// related is the post-rank related-cities map from site-data/aggregates.json
+const data = cityData as {
+  metadata: any;
+  cities: City[];
+  redirects?: Record<string, string>;
+  related?: Record<string, string[]>;
+};
 
 export function getAllCities(): City[] {
   return data.cities;
@@ -69,13 +76,21 @@ export function getAllSlugs(): string[] {
   return data.cities.map(c => c.slug);
 }
 
+export function getRedirectSlugs(): string[] {
+  return Object.keys(data.redirects ?? {});
+}
+
+export function getRedirect(slug: string): string | undefined {
+  return data.redirects?.[slug];
+}
+
 export function getCitiesByRegion(regionSlug: string): City[] {
   return data.cities.filter(c => c.regionSlug === regionSlug);
 }
 
 export function getRelatedCities(city: City): City[] {
-  return city.relatedCities
-    .map(slug => getCityBySlug(slug))
+  return (data.related?.[city.slug] ?? city.relatedCities)
+    .map(slug => getCityBySlug(getRedirect(slug) ?? slug))
     .filter((c): c is City => c !== undefined);
 }
 
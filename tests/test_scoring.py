@@ -0,0 +1,54 @@
+"""Regression test: the scoring engine reproduces the published scores and tiers."""
+
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import agent
+
+CITIES_DIR = Path(__file__).resolve().parent.parent / "data" / "cities"
+
+
+def load_fixtures() -> list[dict]:
+    cities = []
+    for path in sorted(CITIES_DIR.glob("*.json")):
+        with open(path, encoding="utf-8") as f:
+            city = json.load(f)
+        if isinstance(city.get("scores"), dict):
+            city["_file"] = path.name
+            cities.append(city)
+    return cities
+
+
+@pytest.fixture(scope="module")
+def fixtures() -> list[dict]:
+    cities = load_fixtures()
+    assert cities, f"no city fixtures in {CITIES_DIR}"
+    return cities
+
+
+def test_score_corpus_matches_stored_scores(fixtures):
+    overall, tiers = agent.score_corpus(fixtures, "site")
+
+    mismatches = [
+        f"{city['_file']}: overallScore {city.get('overallScore')} != {score}"
+        for city, score in zip(fixtures, overall)
+        if not np.isclose(score, city.get("overallScore", np.nan))
+    ]
+    assert not mismatches, "\n".join(mismatches)
+
+    mismatches = [
+        f"{city['_file']}: badgeClass {city.get('badgeClass')} != {tier}"
+        for city, tier in zip(fixtures, tiers)
+        if tier != city.get("badgeClass")
+    ]
+    assert not mismatches, "\n".join(mismatches)
+
+
+def test_single_city_wrappers_agree_with_corpus(fixtures):
+    overall, tiers = agent.score_corpus(fixtures[:25], "site")
+    for city, score, tier in zip(fixtures[:25], overall, tiers):
+        assert agent.calculate_overall_score(city["scores"], "site") == pytest.approx(score)
+        assert agent.determine_tier(float(score), "site")[0] == tier